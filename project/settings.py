@@ -137,6 +137,27 @@ MEDIA_ROOT = BASE_DIR.joinpath(MEDIA_URL)
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR.joinpath(STATIC_URL)
 
+# слепок модели рекомендаций, пустая строка отключает сохранение
+COLAB_FILTER_SNAPSHOT = config("COLAB_FILTER_SNAPSHOT", default=str(BASE_DIR / "colab_filter"))
+# cosine - похожие челики, svd - матричное разложение, item - похожие картинки
+COLAB_FILTER_BACKEND = config("COLAB_FILTER_BACKEND", default="cosine")
+# приближенный поиск похожих челиков (LSH), 0 таблиц - точный перебор всех пар;
+# больше таблиц - выше полнота, больше бит - меньше корзины и быстрее сборка
+COLAB_FILTER_LSH_TABLES = config("COLAB_FILTER_LSH_TABLES", default=0, cast=int)
+COLAB_FILTER_LSH_BITS = config("COLAB_FILTER_LSH_BITS", default=12, cast=int)
+# процессы для построения индекса соседей, 0 - по числу ядер
+COLAB_FILTER_WORKERS = config("COLAB_FILTER_WORKERS", default=0, cast=int)
+# картинка с phash не дальше этого числа бит от уже загруженной считается повтором, 0 - только одинаковые хэши
+PHASH_DISTANCE = config("PHASH_DISTANCE", default=6, cast=int)
+# процессы для хэширования загруженных картинок (0 - по числу ядер) и сколько картинок ждут их одновременно
+# (0 - по две на процесс)
+PHASH_WORKERS = config("PHASH_WORKERS", default=0, cast=int)
+PHASH_QUEUE = config("PHASH_QUEUE", default=0, cast=int)
+# сколько секунд ждать хэш одной картинки; зависший процесс пула не держит воркер загрузок вечно
+PHASH_TIMEOUT = config("PHASH_TIMEOUT", default=60, cast=int)
+# потоки, которые скачивают и сохраняют картинки из очереди загрузок
+UPLOAD_WORKERS = config("UPLOAD_WORKERS", default=4, cast=int)
+
 LOGGING = {
     'version': 1,
     'handlers': {
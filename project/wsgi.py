@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 application = get_wsgi_application()
+
+# воркеры загрузок - только в процессе, который принимает вебхук: save_photo будит их через UPLOAD_WAKEUP.
+# views их не запускает, иначе check, migrate и test тоже разбирали бы очередь
+from tgbot.tg_logic import start_upload_workers  # noqa: E402
+
+start_upload_workers()
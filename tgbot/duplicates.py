@@ -0,0 +1,177 @@
+# поиск почти одинаковых картинок по phash без django: модуль импортируют процессы пула хэширования
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import combinations
+from threading import BoundedSemaphore, Lock
+
+import imagehash
+from PIL import Image as PILImage
+
+PHASH_BITS = 64
+PHASH_MASK = (1 << PHASH_BITS) - 1
+# хэш режется на части, по каждой своя таблица: если хэши отличаются не больше чем на r бит,
+# то хотя бы в одной части они отличаются не больше чем на r // PHASH_CHUNKS бит
+PHASH_CHUNKS = 4
+CHUNK_BITS = PHASH_BITS // PHASH_CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def phash_to_int(phash):
+    # ImageHash или его hex-строка в знаковое 64-битное число, как хранит BigIntegerField
+    value = int(str(phash), 16) & PHASH_MASK
+    return value - (1 << PHASH_BITS) if value >> (PHASH_BITS - 1) else value
+
+
+def hamming(a, b):
+    # маска убирает знак: у отрицательных чисел в питоне бесконечно много единиц слева
+    return ((a ^ b) & PHASH_MASK).bit_count()
+
+
+def split_chunks(phash):
+    return [(phash >> (CHUNK_BITS * i)) & CHUNK_MASK for i in range(PHASH_CHUNKS)]
+
+
+@lru_cache
+def flip_masks(distance):
+    # все маски части хэша, в которых не больше distance единиц
+    return [
+        sum(1 << bit for bit in bits)
+        for flips in range(distance + 1) for bits in combinations(range(CHUNK_BITS), flips)
+    ]
+
+
+class PhashIndex():
+    # multi-index hashing: кандидаты достаются из таблиц частей по точному совпадению части с точностью
+    # до r // PHASH_CHUNKS бит, расстояние до всего хэша считается только для них
+    def __init__(self, images=()):
+        self.lock = Lock()
+        self.hashes = {}
+        self.tables = [{} for _ in range(PHASH_CHUNKS)]
+        for image_id, phash in images:
+            self.add(phash, image_id)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, phash, image_id):
+        with self.lock:
+            if image_id in self.hashes:
+                self.remove_unlocked(image_id)
+            self.hashes[image_id] = phash
+            for table, chunk in zip(self.tables, split_chunks(phash)):
+                table.setdefault(chunk, set()).add(image_id)
+
+    def remove(self, image_id):
+        with self.lock:
+            self.remove_unlocked(image_id)
+
+    def remove_unlocked(self, image_id):
+        phash = self.hashes.pop(image_id, None)
+        if phash is None:
+            return
+        for table, chunk in zip(self.tables, split_chunks(phash)):
+            table[chunk].discard(image_id)
+            if not table[chunk]:
+                del table[chunk]
+
+    def search(self, phash, radius):
+        # [(расстояние, id картинки)] по возрастанию расстояния
+        masks = flip_masks(radius // PHASH_CHUNKS)
+        with self.lock:
+            candidates = set()
+            for table, chunk in zip(self.tables, split_chunks(phash)):
+                for mask in masks:
+                    candidates.update(table.get(chunk ^ mask, ()))
+            found = [(hamming(phash, self.hashes[image_id]), image_id) for image_id in candidates]
+        return sorted(item for item in found if item[0] <= radius)
+
+    def nearest(self, phash, radius):
+        # id ближайшей картинки в радиусе или None
+        found = self.search(phash, radius)
+        return found[0][1] if found else None
+
+
+class BloomFilter():
+    # множество строк без хранения самих строк: около 10 бит на элемент при 1% ложных срабатываний.
+    # "нет" всегда точное, "да" нужно проверять по базе; удалить элемент нельзя, удаленные дают ложное "да"
+    def __init__(self, capacity, error_rate=0.01, keys=()):
+        capacity = max(1, capacity)
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.lock = Lock()
+        for key in keys:
+            self.add(key)
+
+    def positions(self, key):
+        # двойное хэширование: k позиций из двух половин одного blake2b
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes_count)]
+
+    def add(self, key):
+        positions = self.positions(key)
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] >> (position & 7) & 1 for position in self.positions(key))
+
+
+def image_phash(file_bytes):
+    # выполняется в процессе пула: декодирование и хэш держат GIL, в потоке бота они тормозят остальные апдейты
+    pil_image = PILImage.open(io.BytesIO(file_bytes))
+    return str(imagehash.phash(pil_image)), pil_image.width * pil_image.height
+
+
+class HashPool():
+    # пул процессов для image_phash; не больше queue_size картинок в работе и в очереди.
+    # слот берется до скачивания, так что остальные обработчики ждут его, еще не держа байты в памяти
+    def __init__(self, workers=0, queue_size=0):
+        # 0 процессов - по числу ядер, 0 в очереди - по два на процесс
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = BoundedSemaphore(queue_size or self.workers * 2)
+        self.lock = Lock()
+        self.executor = None
+
+    def get_executor(self):
+        # пул поднимается при первой картинке; spawn, потому что бот многопоточный
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.executor
+
+    def phash(self, file_bytes, timeout=None):
+        # (hex phash, число пикселей)
+        return self.download_phash(lambda: file_bytes, timeout)
+
+    def download_phash(self, download, timeout=None):
+        # то же для байтов, которые вернет download(); скачивание идет уже внутри слота
+        with self.slots:
+            file_bytes = download()
+            executor = self.get_executor()
+            try:
+                return executor.submit(image_phash, file_bytes).result(timeout)
+            except (BrokenProcessPool, TimeoutError):
+                # упавший процесс ломает весь пул, зависший занимает его процесс навсегда:
+                # следующая картинка поднимет новый пул
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = None
+                        executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
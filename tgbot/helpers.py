@@ -1,5 +1,7 @@
 import time
 
+import numpy as np
+
 TIMERS = {}
 
 
@@ -24,4 +26,15 @@ def timeit(func):
         TIMERS[str(func)] = [timer] + TIMERS.get(str(func), [])[:1000]
         print(timers_view())
         return result
-    return inner
\ No newline at end of file
+    return inner
+
+
+def percentiles(timings):
+    if not timings:
+        return {}
+    return {
+        "p50": float(np.percentile(timings, 50)),
+        "p95": float(np.percentile(timings, 95)),
+        "p99": float(np.percentile(timings, 99)),
+        "max": float(np.max(timings)),
+    }
@@ -0,0 +1,179 @@
+import contextlib
+import io
+import json
+import resource
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from tgbot.helpers import percentiles
+from tgbot.models import Profile, Image, ImageScore
+from tgbot.recommendations import BACKENDS, ColabFilter
+
+
+class Command(BaseCommand):
+    help = "Замеры ColabFilter на синтетических данных, данные откатываются после замера"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+        parser.add_argument("--images-per-user", type=float, default=2.0)
+        parser.add_argument("--scores-per-user", type=float, default=15.0)
+        parser.add_argument("--predict-samples", type=int, default=200)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--backend", choices=sorted(BACKENDS), default="cosine")
+        parser.add_argument("--lsh-tables", type=int, default=8)
+        parser.add_argument("--lsh-bits", type=int, default=6)
+        parser.add_argument("--output", default="benchmark.json")
+
+    def handle(self, *args, **options):
+        results = []
+        for users in options["users"]:
+            result = run_benchmark(
+                users=users,
+                images=max(1, int(users * options["images_per_user"])),
+                scores_per_user=options["scores_per_user"],
+                predict_samples=options["predict_samples"],
+                seed=options["seed"],
+                backend=options["backend"],
+                lsh_tables=options["lsh_tables"],
+                lsh_bits=options["lsh_bits"],
+            )
+            self.stdout.write(json.dumps(result))
+            results.append(result)
+        with open(options["output"], "w") as file:
+            json.dump({"commit": git_commit(), "created_at": time.time(), "results": results}, file, indent=2)
+
+
+def git_commit():
+    with contextlib.suppress(OSError, subprocess.CalledProcessError):
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+
+
+def measure(func, *args, reset=None, memory=True, **kwargs):
+    # время и пиковая память снимаются в разных запусках: tracemalloc замедляет каждое выделение памяти.
+    # reset возвращает состояние перед повторным запуском
+    def run():
+        if reset is not None:
+            reset()
+        # timeit печатает все таймеры на каждый вызов, в замерах это только шум
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(*args, **kwargs)
+
+    start = time.perf_counter()
+    result = run()
+    stage = {"seconds": time.perf_counter() - start}
+    if memory:
+        tracemalloc.start()
+        try:
+            run()
+            stage["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, stage
+
+
+def synthetic_scores(users, images, scores_per_user, rng):
+    # активность челиков и популярность картинок распределены по степенному закону
+    activity = np.clip((rng.pareto(1.5, users) + 1) * scores_per_user / 3, 1, images).astype(np.int64)
+    popularity = 1 / np.arange(1, images + 1) ** 0.8
+    popularity = rng.permutation(popularity / popularity.sum())
+    rows = np.repeat(np.arange(users), activity)
+    cols = rng.choice(images, size=len(rows), p=popularity)
+    _, unique = np.unique(rows * images + cols, return_index=True)
+    rows, cols = rows[unique], cols[unique]
+    scores = rng.choice([2, 1, -1, -2], size=len(rows), p=[0.15, 0.55, 0.25, 0.05])
+    uploaders = rng.choice(users, size=images, p=activity / activity.sum())
+    return rows, cols, scores, uploaders
+
+
+def create_synthetic_data(users, images, scores_per_user, rng, batch_size=10000):
+    rows, cols, scores, uploaders = synthetic_scores(users, images, scores_per_user, rng)
+    tg_id_start = (Profile.objects.aggregate(tg_id=Max("tg_id"))["tg_id"] or 0) + 1
+    Profile.objects.bulk_create(
+        (Profile(tg_id=tg_id_start + i, name=f"benchmark {i}") for i in range(users)), batch_size=batch_size
+    )
+    profile_ids = np.array(
+        Profile.objects.filter(tg_id__gte=tg_id_start).order_by("tg_id").values_list("id", flat=True)
+    )
+    image_id_start = (Image.objects.aggregate(id=Max("id"))["id"] or 0) + 1
+    Image.objects.bulk_create(
+        (
+            Image(
+                profile_id=int(profile_ids[uploaders[i]]),
+                file_id=f"benchmark-{image_id_start + i}",
+                file_unique_id=f"benchmark-{image_id_start + i}",
+                phash=f"benchmark-{image_id_start + i}",
+            ) for i in range(images)
+        ),
+        batch_size=batch_size,
+    )
+    image_ids = np.array(
+        Image.objects.filter(file_unique_id__startswith="benchmark-").order_by("id").values_list("id", flat=True)
+    )
+    # загрузивший картинку ставит ей 2, как в Image.new_image
+    own = np.isin(rows * images + cols, uploaders * images + np.arange(images))
+    rows, cols, scores = rows[~own], cols[~own], scores[~own]
+    ImageScore.objects.bulk_create(
+        (
+            ImageScore(profile_id=int(profile_ids[row]), image_id=int(image_ids[col]), score=int(score))
+            for row, col, score in zip(
+                np.concatenate([rows, uploaders]),
+                np.concatenate([cols, np.arange(images)]),
+                np.concatenate([scores, np.full(images, 2)]),
+            )
+        ),
+        batch_size=batch_size,
+    )
+    return profile_ids, image_ids
+
+
+def neighbours_recall(exact, approximate):
+    # доля точных соседей, найденных приближенным поиском
+    found, total = 0, 0
+    for exact_row, approximate_row in zip(exact, approximate):
+        exact_row = exact_row[exact_row >= 0]
+        found += np.isin(exact_row, approximate_row).sum()
+        total += len(exact_row)
+    return float(found / total) if total else 1.0
+
+
+def run_benchmark(users, images, scores_per_user=15.0, predict_samples=200, seed=0, backend="cosine",
+                  lsh_tables=8, lsh_bits=6):
+    rng = np.random.default_rng(seed)
+    result = {"backend": backend, "users": users, "images": images}
+    with transaction.atomic():
+        profile_ids, _ = create_synthetic_data(users, images, scores_per_user, rng)
+        result["scores"] = ImageScore.objects.count()
+
+        model = BACKENDS[backend]()
+        _, result["update_data_from_db"] = measure(model.update_data_from_db)
+        _, result["fit"] = measure(model.fit)
+        if backend == "cosine" and lsh_tables:
+            exact = model.neighbours.copy()
+            _, result["lsh"] = measure(model.update_cosine, lsh_tables=lsh_tables, lsh_bits=lsh_bits)
+            result["lsh"].update(tables=lsh_tables, bits=lsh_bits, recall=neighbours_recall(exact, model.neighbours))
+
+        cf = ColabFilter(background=False, snapshot_path="", backend=backend)
+        latencies = []
+        for profile_id in rng.choice(profile_ids, size=min(predict_samples, users), replace=False):
+            _, stage = measure(cf.predict, int(profile_id), memory=False)
+            latencies.append(stage["seconds"])
+        result["predict"] = percentiles(latencies)
+        _, result["predict_many"] = measure(cf.predict_many, profile_ids.tolist()[:predict_samples * 5], 1)
+
+        def reset_timers():
+            # счетчик картинок с нуля, иначе check_updates не увидит новых картинок и не пересоберет модель
+            cf.update_timer, cf.count_timer, cf.image_count = 0, 0, 0
+
+        previous = cf.model
+        _, result["check_updates"] = measure(cf.check_updates, reset=reset_timers)
+        result["check_updates"]["rebuilt"] = cf.model is not previous
+        result["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # синтетика в базе не остается
+        transaction.set_rollback(True)
+    return result
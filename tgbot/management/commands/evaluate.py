@@ -0,0 +1,89 @@
+import contextlib
+import io
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from tgbot.helpers import percentiles
+from tgbot.models import ImageScore, ImageBlock
+from tgbot.recommendations import BACKENDS, read_scores
+
+
+class Command(BaseCommand):
+    help = "Офлайн-оценка ColabFilter: обучение на старых оценках, проверка на последних"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--test-fraction", type=float, default=0.1)
+        parser.add_argument("--k", type=int, nargs="+", default=[10, 50])
+        parser.add_argument("--max-users", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--backend", choices=sorted(BACKENDS), default="cosine")
+        parser.add_argument("--output", default=None)
+
+    def handle(self, *args, **options):
+        result = evaluate(
+            test_fraction=options["test_fraction"],
+            ks=options["k"],
+            max_users=options["max_users"],
+            seed=options["seed"],
+            backend=options["backend"],
+        )
+        self.stdout.write(json.dumps(result, indent=2))
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(result, file, indent=2)
+
+
+def time_split(test_fraction):
+    score_data = ImageScore.objects.exclude(image__in=ImageBlock.objects.values("image"))
+    count = score_data.count()
+    test_count = int(count * test_fraction)
+    if not count or not test_count:
+        return None, score_data, score_data.none()
+    split = score_data.order_by("-datetime").values_list("datetime", flat=True)[test_count - 1]
+    return split, score_data.filter(datetime__lt=split), score_data.filter(datetime__gte=split)
+
+
+def evaluate(test_fraction=0.1, ks=(10, 50), max_users=1000, seed=0, backend="cosine"):
+    split, train, test = time_split(test_fraction)
+    result = {"backend": backend, "split": split.isoformat() if split else None, "train_scores": train.count(), "test_scores": test.count()}
+    scores = read_scores(train)
+    if not len(scores[0]):
+        return result
+
+    model = BACKENDS[backend]()
+    model.load_scores(*scores)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.fit()
+
+    # понравившиеся в отложенной части картинки, кроме своих загрузок (им оценка ставится сама)
+    relevant = {}
+    for profile_id, image_id, uploader_id in test.filter(score__gt=0).values_list("profile", "image", "image__profile"):
+        if profile_id != uploader_id and profile_id in model.user_index:
+            relevant.setdefault(profile_id, set()).add(image_id)
+    profile_ids = sorted(relevant)
+    if len(profile_ids) > max_users:
+        profile_ids = np.random.default_rng(seed).choice(profile_ids, size=max_users, replace=False).tolist()
+    result["test_users"] = len(profile_ids)
+
+    latencies = []
+    recommendations = {}
+    for profile_id in profile_ids:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            prediction = model.predict(profile_id, count=max(ks), last_dislikes={})
+        latencies.append(time.perf_counter() - start)
+        recommendations[profile_id] = [image["image_id"] for image in prediction]
+    result["predict_latency"] = percentiles(latencies)
+
+    for k in ks:
+        hits = [len(set(recommendations[profile_id][:k]) & relevant[profile_id]) for profile_id in profile_ids]
+        recommended = set().union(*(recommendations[profile_id][:k] for profile_id in profile_ids))
+        result[f"precision@{k}"] = float(np.mean([hit / k for hit in hits])) if hits else 0.0
+        result[f"recall@{k}"] = float(np.mean([
+            hit / len(relevant[profile_id]) for hit, profile_id in zip(hits, profile_ids)
+        ])) if hits else 0.0
+        result[f"coverage@{k}"] = len(recommended) / len(model.image_ids)
+    return result
@@ -1,8 +1,9 @@
 from django.core.management.base import BaseCommand
-from tgbot.tg_logic import bot
+from tgbot.tg_logic import bot, start_upload_workers
 
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
         bot.remove_webhook()
+        start_upload_workers()
         bot.infinity_polling(long_polling_timeout=120)
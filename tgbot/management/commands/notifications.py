@@ -15,8 +15,9 @@ class Command(BaseCommand):
 
 def job():
     profiles = Profile.list_need_notification()
+    predictions = COLAB_FILTER.predict_many([profile.id for profile in profiles], count=1)
     for profile in profiles:
-        if file_unique_ids := COLAB_FILTER.predict(profile.id):
+        if file_unique_ids := predictions.get(profile.id):
             try:
                 bot.send_message(
                     chat_id=profile.tg_id,
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tgbot.models import ProfileSimilarity
+
+
+class Command(BaseCommand):
+    help = "Пересчет таблицы похожих профилей для рекомендаций без ColabFilter"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true")
+
+    def handle(self, *args, **options):
+        if options["loop"]:
+            similarity_loop()
+        else:
+            self.stdout.write(f"refreshed profiles: {job()}")
+
+
+def job():
+    profile_ids = list(ProfileSimilarity.list_need_refresh())
+    for profile_id in profile_ids:
+        ProfileSimilarity.refresh_profile(profile_id)
+    return len(profile_ids)
+
+
+def similarity_loop():
+    while True:
+        try:
+            print(f"refreshed profiles: {job()}")
+        except Exception as e:
+            print(e)
+        time.sleep(15 * 60)
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgbot', '0018_delete_imageuploadcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='similarity_updated',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Пересчет похожих профилей'),
+        ),
+        migrations.CreateModel(
+            name='ProfileSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taste_sim', models.FloatField(verbose_name='Схожесть вкусов')),
+                ('scores_count', models.IntegerField(verbose_name='Общих оценок')),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_to', to='tgbot.profile', verbose_name='Похожий пользователь')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarity', to='tgbot.profile', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Похожий профиль',
+                'verbose_name_plural': 'Похожие профили',
+                'unique_together': {('profile', 'neighbour')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+def phash_to_int(phash):
+    # копия tgbot.duplicates.phash_to_int на момент миграции: hex-строка в знаковое 64-битное число
+    value = int(str(phash), 16) & 0xFFFFFFFFFFFFFFFF
+    return value - (1 << 64) if value >> 63 else value
+
+
+def fill_phash_int(apps, schema_editor):
+    Image = apps.get_model('tgbot', 'Image')
+    images = []
+    for image in Image.objects.filter(phash_int__isnull=True).only('id', 'phash').iterator(chunk_size=10000):
+        try:
+            image.phash_int = phash_to_int(image.phash)
+        except ValueError:
+            continue
+        images.append(image)
+    Image.objects.bulk_update(images, ['phash_int'], batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgbot', '0019_profile_similarity_updated_profilesimilarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='phash_int',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Хэш изображения числом'),
+        ),
+        migrations.RunPython(fill_phash_int, migrations.RunPython.noop),
+    ]
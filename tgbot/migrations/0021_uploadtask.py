@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import tgbot.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgbot', '0020_image_phash_int'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(verbose_name='Идентификатор чата')),
+                ('message_id', models.BigIntegerField(verbose_name='Идентификатор сообщения пользователя')),
+                ('file_id', models.TextField(verbose_name='Идентификатор изображения')),
+                ('file_unique_id', models.TextField(verbose_name='Уникальный идентификатор изображения')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Попыток обработки')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='Занята до')),
+                ('datetime', models.DateTimeField(default=tgbot.models.datetime_now, verbose_name='Дата добавления')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_task', to='tgbot.profile', verbose_name='Профиль владельца')),
+            ],
+            options={
+                'verbose_name': 'Загрузка в очереди',
+                'verbose_name_plural': 'Очередь загрузок',
+            },
+        ),
+    ]
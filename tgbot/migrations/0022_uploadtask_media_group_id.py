@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgbot', '0021_uploadtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadtask',
+            name='media_group_id',
+            field=models.TextField(blank=True, db_index=True, null=True, verbose_name='Идентификатор альбома'),
+        ),
+    ]
@@ -1,13 +1,13 @@
 import datetime
 from functools import lru_cache
 
-from django.db.models.functions import Cast, Coalesce
 from django.utils import timezone
-from django.db import models
-from django.db.models import Sum, Q, Count, Max
+from django.db import models, transaction
+from django.db.models import Sum, Q, Count, Max, Case, When, F
 from django.utils.safestring import mark_safe
 
 from project.settings import bot
+from tgbot.duplicates import phash_to_int
 
 
 def datetime_now():
@@ -20,6 +20,7 @@ class Profile(models.Model):
     last_activity = models.DateTimeField(verbose_name="Активность пользователя", default=datetime_now)
     last_bot_message = models.DateTimeField(verbose_name="Сообщение от бота", default=datetime_now)
     language_code = models.TextField(verbose_name="Код языка", default="en")
+    similarity_updated = models.DateTimeField(verbose_name="Пересчет похожих профилей", null=True, blank=True)
 
     @classmethod
     def update_profile(cls, tg_id, name, language_code):
@@ -78,38 +79,11 @@ class Profile(models.Model):
 
     @classmethod
     def get_similar_profiles(cls, tg_id):
-        my_likes = Image.get_likes(tg_id)
-        my_dislikes = Image.get_dislikes(tg_id)
-        scores_to_likes = Cast(
-            Coalesce(Sum(
-                "image_score__score",
-                filter=Q(image_score__image__in=my_likes),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        )
-        scores_to_dislikes = Cast(
-            Coalesce(Sum(
-                "image_score__score",
-                filter=Q(image_score__image__in=my_dislikes),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        )
-        scores_count = Cast(
-            Coalesce(Count(
-                "image_score",
-                filter=Q(image_score__image__in=my_likes) | Q(image_score__image__in=my_dislikes),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        )
-        profiles = cls.objects.exclude(tg_id=tg_id).values('tg_id') \
-            .annotate(
-                scores_count=scores_count,
-                taste_sim=(scores_to_likes - scores_to_dislikes) / (models.F('scores_count') + 1),
-            ).filter(scores_count__gte=1)
-        return profiles
+        # из таблицы ProfileSimilarity, которую пересчитывает команда similarity
+        return ProfileSimilarity.objects \
+            .filter(profile__tg_id=tg_id) \
+            .annotate(tg_id=F('neighbour__tg_id')) \
+            .values('tg_id', 'taste_sim', 'scores_count')
 
     class Meta:
         verbose_name = "Профиль пользователя"
@@ -124,6 +98,8 @@ class Image(models.Model):
     file_id = models.TextField(verbose_name="Идентификатор изображения", default="")
     file_unique_id = models.TextField(verbose_name="Уникальный идентификатор изображения", unique=True)
     phash = models.TextField(verbose_name="Хэш изображения", unique=True)
+    # тот же хэш 64-битным числом для поиска почти одинаковых картинок по расстоянию Хэмминга
+    phash_int = models.BigIntegerField(verbose_name="Хэш изображения числом", null=True, blank=True)
     datetime = models.DateTimeField(verbose_name="Дата добавления", default=datetime_now)
 
     @lru_cache
@@ -165,6 +141,7 @@ class Image(models.Model):
             file_id=file_id,
             file_unique_id=file_unique_id,
             phash=phash,
+            phash_int=phash_to_int(phash),
         )
         ImageScore.objects.create(
             profile=profile,
@@ -173,9 +150,28 @@ class Image(models.Model):
         )
         return image
 
+    @classmethod
+    def new_images(cls, tg_id, files):
+        # то же, что new_image для пачки (file_id, file_unique_id, phash): две вставки вместо двух на картинку
+        profile = Profile.objects.get(tg_id=tg_id)
+        images = cls.objects.bulk_create([
+            cls(
+                profile=profile,
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+                phash=phash,
+                phash_int=phash_to_int(phash),
+            ) for file_id, file_unique_id, phash in files
+        ])
+        ImageScore.objects.bulk_create([ImageScore(profile=profile, image=image, score=2) for image in images])
+        return images
+
     @classmethod
     def delete_image(cls, tg_id, file_unique_id):
-        cls.objects.get(profile__tg_id=tg_id, file_unique_id=file_unique_id).delete()
+        image = cls.objects.get(profile__tg_id=tg_id, file_unique_id=file_unique_id)
+        image_id = image.id
+        image.delete()
+        return image_id
 
     @classmethod
     def get_last_disliked_profile(cls, tg_id,):
@@ -206,79 +202,57 @@ class Image(models.Model):
         return cls.objects.filter(image_score__profile__tg_id=tg_id, image_score__score__lte=0)
 
     @classmethod
-    def colab_filter_images(cls, tg_id, count=50):
-        profiles = Profile.get_similar_profiles(tg_id)
+    def colab_filter_images(cls, profile_id, count=50):
+        # рекомендации только на базе: оценки похожих профилей из ProfileSimilarity одним запросом с join
+        profile = Profile.objects.get(id=profile_id)
         height = 0.2
         negative = -0.2
-        height_tier_profiles = Cast(
-            Coalesce(Sum(
-                models.F("image_score__score"),
-                filter=Q(image_score__profile__tg_id__in=profiles.filter(taste_sim__gte=height).values('tg_id')),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        )
-
-        low_tier_profiles = Cast(
-            Coalesce(Sum(
-                models.F("image_score__score"),
-                filter=Q(image_score__profile__tg_id__in=profiles.filter(
-                    taste_sim__gte=0,
-                    taste_sim__lt=height
-                ).values('tg_id')),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        ) * 0.5
-
-        positive_score = height_tier_profiles + low_tier_profiles
-
-        low_negative_profiles = Cast(
-            Coalesce(Count(
-                models.F("profile"),
-                filter=Q(profile__tg_id__in=profiles.filter(
-                    taste_sim__gte=negative,
-                    taste_sim__lt=0
-                ).values('tg_id')),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        ) * 0.2
-
-        height_negative_profiles = Cast(
-            Coalesce(Count(
-                models.F("profile"),
-                filter=Q(profile__tg_id__in=profiles.filter(taste_sim__lt=negative).values('tg_id')),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        ) * 0.5
-
-        negative_score = low_negative_profiles + height_negative_profiles
-
-        score_count = Cast(
-            Coalesce(Count(
-                "image_score",
-                filter=Q(image_score__profile__tg_id__in=profiles.values('tg_id')),
-                distinct=True,
-            ), 0.0),
-            models.FloatField(),
-        )
-
-        reported_profile = cls.get_last_reported_profile(tg_id)
-
-        image_ids = list(
-            cls.objects
-                .exclude(image_score__profile__tg_id=tg_id)
-                .exclude(profile=reported_profile)
-                .filter(block__isnull=True)
-                .values('file_unique_id')
-                .annotate(report_count=Count("report", distinct=True))
-                .filter(report_count__lte=2)
-                .annotate(taste_similarity=positive_score / (score_count + 1) - negative_score)
-                .order_by('-taste_similarity', '?')[:count]
-        )
-        return image_ids
+        seen = ImageScore.objects.filter(profile=profile).values("image")
+        reported = Report.objects.values("image").annotate(report_count=Count("id")).filter(report_count__gt=2)
+        hidden = Q(image__in=seen) | Q(image__in=reported.values("image")) | Q(image__block__isnull=False) \
+            | Q(image__profile=cls.get_last_reported_profile(profile.tg_id))
+        candidates = ImageScore.objects \
+            .filter(profile__similar_to__profile=profile, profile__similar_to__taste_sim__gte=0) \
+            .exclude(hidden) \
+            .values("image", "image__profile") \
+            .annotate(
+                positive_score=Sum(Case(
+                    When(profile__similar_to__taste_sim__gte=height, then=F("score")),
+                    default=F("score") * 0.5,
+                    output_field=models.FloatField(),
+                )),
+                score_count=Count("id"),
+            )
+        # авторы с непохожим вкусом опускают свои картинки
+        uploader_penalty = {
+            neighbour_id: 0.2 if sim >= negative else 0.5
+            for neighbour_id, sim in ProfileSimilarity.objects
+                .filter(profile=profile, taste_sim__lt=0)
+                .values_list("neighbour_id", "taste_sim")
+        }
+        images = sorted(
+            (
+                {
+                    "image_id": candidate["image"],
+                    "taste_similarity":
+                        candidate["positive_score"] / (candidate["score_count"] + 1)
+                        - uploader_penalty.get(candidate["image__profile"], 0),
+                } for candidate in candidates
+            ),
+            key=lambda image: -image["taste_similarity"],
+        )[:count]
+        # остаток страницы - случайные непросмотренные картинки, как раньше при нулевой схожести
+        if len(images) < count:
+            images += [
+                {"image_id": image_id, "taste_similarity": 0}
+                for image_id in cls.objects
+                    .exclude(id__in=[image["image_id"] for image in images])
+                    .exclude(Q(id__in=seen) | Q(id__in=reported.values("image")) | Q(block__isnull=False)
+                             | Q(profile=cls.get_last_reported_profile(profile.tg_id)))
+                    .order_by('?')
+                    .values_list("id", flat=True)[:count - len(images)]
+            ]
+        return images
 
     @classmethod
     def update_image_cache(cls, tg_id, image_ids: list[dict]):
@@ -327,7 +301,7 @@ class ImageScore(models.Model):
         return cls.objects.update_or_create(
             profile=Profile.objects.get(tg_id=tg_id),
             image=Image.objects.get(file_unique_id=file_unique_id),
-            defaults={"score": score},
+            defaults={"score": score, "datetime": datetime_now()},
         )[0]
 
     @classmethod
@@ -338,6 +312,18 @@ class ImageScore(models.Model):
             datetime__gte=datetime_now() - datetime.timedelta(days=days)
         ).values_list("image__profile", flat=True).distinct()
 
+    @classmethod
+    def last_dislikes_many(cls, profile_ids, days=1, chunk_size=500):
+        dislikes = {}
+        for start in range(0, len(profile_ids), chunk_size):
+            for profile_id, disliked_profile_id in cls.objects.filter(
+                profile__in=profile_ids[start:start + chunk_size],
+                score__lt=0,
+                datetime__gte=datetime_now() - datetime.timedelta(days=days)
+            ).values_list("profile", "image__profile").distinct():
+                dislikes.setdefault(profile_id, set()).add(disliked_profile_id)
+        return dislikes
+
     class Meta:
         verbose_name = "Оценка изображения"
         verbose_name_plural = "Оценки изображений"
@@ -347,6 +333,61 @@ class ImageScore(models.Model):
         return f"Оценка: {self.profile} - {self.image} ({self.score})"
 
 
+class ProfileSimilarity(models.Model):
+    profile = models.ForeignKey(Profile, verbose_name="Пользователь", related_name='similarity', on_delete=models.CASCADE)
+    neighbour = models.ForeignKey(
+        Profile, verbose_name="Похожий пользователь", related_name='similar_to', on_delete=models.CASCADE
+    )
+    taste_sim = models.FloatField(verbose_name="Схожесть вкусов")
+    scores_count = models.IntegerField(verbose_name="Общих оценок")
+
+    @classmethod
+    def refresh_profile(cls, profile_id, limit=100):
+        # схожесть с теми, кто оценивал те же картинки: их оценки со знаком оценки профиля
+        updated = datetime_now()
+        neighbours = ImageScore.objects \
+            .filter(image__image_score__profile_id=profile_id) \
+            .exclude(profile_id=profile_id) \
+            .values("profile") \
+            .annotate(
+                agreement=Sum(Case(
+                    When(image__image_score__score__gte=1, then=F("score")),
+                    default=-F("score"),
+                )),
+                scores_count=Count("id"),
+            )
+        rows = sorted(
+            (
+                cls(
+                    profile_id=profile_id,
+                    neighbour_id=neighbour["profile"],
+                    taste_sim=neighbour["agreement"] / (neighbour["scores_count"] + 1),
+                    scores_count=neighbour["scores_count"],
+                ) for neighbour in neighbours
+            ),
+            key=lambda row: -abs(row.taste_sim),
+        )[:limit]
+        with transaction.atomic():
+            cls.objects.filter(profile_id=profile_id).delete()
+            cls.objects.bulk_create(rows)
+            Profile.objects.filter(id=profile_id).update(similarity_updated=updated)
+        return len(rows)
+
+    @classmethod
+    def list_need_refresh(cls, max_age=datetime.timedelta(days=1)):
+        # новые оценки профиля меняют его строку сразу, чужие - не позже чем через max_age
+        return Profile.objects.filter(
+            Q(similarity_updated__isnull=True)
+            | Q(similarity_updated__lt=datetime_now() - max_age)
+            | Q(image_score__datetime__gt=F("similarity_updated"))
+        ).distinct().values_list("id", flat=True)
+
+    class Meta:
+        verbose_name = "Похожий профиль"
+        verbose_name_plural = "Похожие профили"
+        unique_together = ['profile', 'neighbour']
+
+
 class Report(models.Model):
     profile = models.ForeignKey(Profile, verbose_name="Пользователь", related_name='report', on_delete=models.CASCADE)
     image = models.ForeignKey(Image, verbose_name="Изображение", related_name='report', on_delete=models.CASCADE)
@@ -417,3 +458,70 @@ class ImageBlock(models.Model):
         return cls.objects.create(
             image=Image.objects.get(file_unique_id=file_unique_id, profile__tg_id=tg_id),
         )
+
+
+# сколько воркер держит задачу загрузки, прежде чем ее сможет взять другой
+UPLOAD_LEASE = datetime.timedelta(minutes=5)
+# картинки альбома приходят отдельными апдейтами, за это время после первой собираются остальные
+MEDIA_GROUP_WINDOW = datetime.timedelta(seconds=2)
+
+
+class UploadTask(models.Model):
+    # присланная картинка ждет скачивания и проверки на повтор; строка удаляется после ответа челику
+    profile = models.ForeignKey(Profile, verbose_name="Профиль владельца", related_name='upload_task', on_delete=models.CASCADE)
+    chat_id = models.BigIntegerField(verbose_name="Идентификатор чата")
+    message_id = models.BigIntegerField(verbose_name="Идентификатор сообщения пользователя")
+    file_id = models.TextField(verbose_name="Идентификатор изображения")
+    file_unique_id = models.TextField(verbose_name="Уникальный идентификатор изображения")
+    media_group_id = models.TextField(verbose_name="Идентификатор альбома", null=True, blank=True, db_index=True)
+    attempts = models.IntegerField(verbose_name="Попыток обработки", default=0)
+    # задачу взял воркер; если он упал вместе с процессом, после этого времени ее возьмет другой
+    locked_until = models.DateTimeField(verbose_name="Занята до", null=True, blank=True)
+    datetime = models.DateTimeField(verbose_name="Дата добавления", default=datetime_now)
+
+    @classmethod
+    def enqueue(cls, tg_id, chat_id, message_id, file_id, file_unique_id, media_group_id=None):
+        return cls.objects.create(
+            profile=Profile.objects.get(tg_id=tg_id),
+            chat_id=chat_id,
+            message_id=message_id,
+            file_id=file_id,
+            file_unique_id=file_unique_id,
+            media_group_id=media_group_id,
+        )
+
+    @classmethod
+    def claim(cls, lease=UPLOAD_LEASE, group_window=MEDIA_GROUP_WINDOW):
+        # самая старая свободная задача, а если она из альбома - все свободные задачи альбома;
+        # альбом отдается не раньше чем через group_window после первой картинки.
+        # условие повторяется в update, так что при гонке воркеров каждую задачу получает
+        # только тот, чье время аренды записалось
+        now = datetime_now()
+        free = Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+        first = cls.objects \
+            .filter(free) \
+            .filter(Q(media_group_id__isnull=True) | Q(datetime__lt=now - group_window)) \
+            .order_by('id') \
+            .values('id', 'media_group_id') \
+            .first()
+        if first is None:
+            return []
+        if first['media_group_id'] is None:
+            batch = Q(id=first['id'])
+        else:
+            batch = Q(media_group_id=first['media_group_id'])
+        locked_until = now + lease
+        cls.objects.filter(free, batch).update(locked_until=locked_until, attempts=F('attempts') + 1)
+        return list(cls.objects.filter(batch, locked_until=locked_until).select_related('profile').order_by('id'))
+
+    @classmethod
+    def release(cls, task_ids):
+        # вернуть задачи в очередь, не дожидаясь конца аренды
+        cls.objects.filter(id__in=task_ids).update(locked_until=None)
+
+    class Meta:
+        verbose_name = "Загрузка в очереди"
+        verbose_name_plural = "Очередь загрузок"
+
+    def __str__(self) -> str:
+        return f"Загрузка: {self.profile} - {self.file_unique_id} ({self.datetime})"
@@ -1,140 +1,1279 @@
-import random
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from threading import Lock, RLock, Thread
 
-import pandas as pd
 import numpy as np
-import numpy.ma as ma
+from django.conf import settings
+from django.db.models import F, Max, Q
+from scipy import sparse
+from scipy.sparse.linalg import svds
 
-from tgbot.models import ImageScore, ImageBlock, Image
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from tgbot.models import ImageScore, ImageBlock, Image, ProfileSimilarity, Report, datetime_now
 from tgbot.helpers import timeit
+from tgbot.similarity import top_neighbours, merge_neighbours, neighbour_rows, init_worker, worker_neighbour_rows
 
 
-class ColabFilter():
+NEIGHBOURS_COUNT = 100
+# ограничение на размер плотного блока схожести при построении индекса соседей
+BLOCK_ELEMENTS = 2 ** 24
+# меняется при любом изменении состава или формата файлов слепка модели
+SNAPSHOT_VERSION = 6
+SNAPSHOT_GENERATIONS = 2
+# как часто воркер без пересборки проверяет, не опубликовано ли новое поколение
+GENERATION_CHECK_INTERVAL = 30
+# размерность векторов челиков и картинок в FactorModel
+FACTORS_COUNT = 64
+# по скольким последним лайкам челика ItemModel собирает кандидатов
+LIKED_COUNT = 50
+# популярность: вклад лайка уменьшается вдвое за POPULAR_HALF_LIFE дней, старше POPULAR_DAYS не считается,
+# каждая жалоба вычитает REPORT_WEIGHT
+POPULAR_HALF_LIFE = 7
+POPULAR_DAYS = 60
+REPORT_WEIGHT = 3
+# картинки с таким числом жалоб не показываются, как в Image.colab_filter_images
+REPORT_LIMIT = 3
+# сколько оценок за раз забирается с курсора базы при загрузке
+LOAD_CHUNK = 10000
+# запись оценки при загрузке: 17 байт вместо словаря и строки DataFrame
+SCORE_DTYPE = np.dtype([("profile_id", np.int64), ("image_id", np.int64), ("score", np.int8)])
+# с какого числа строк индекс соседей строится пулом процессов, на меньших запуск пула дороже расчета
+PARALLEL_MIN_ROWS = 10000
+# корзина LSH больше этого размера делится на случайные части, чтобы блок схожести был ограничен
+LSH_BUCKET = 2048
+# с каким хвостом оценок после слепка пересборщик не догоняет его при старте, а сразу пересобирает модель
+CATCH_UP_LIMIT = 20000
+# до стольких строк схожесть считается с плотными векторами, на больших пачках быстрее разреженное произведение
+DENSE_SIMILARITY_ROWS = 32
+# после стольких клеток overlay пересборка дешевле, чем обновлять дельты и centred на каждую оценку
+OVERLAY_REBUILD_CELLS = 50000
+
+
+def read_scores(score_data):
+    # оценки читаются с курсора порциями сразу в компактный массив, без промежуточных списков
+    scores = np.fromiter(
+        score_data.values_list("profile_id", "image_id", "score").iterator(chunk_size=LOAD_CHUNK), dtype=SCORE_DTYPE
+    )
+    return scores["profile_id"], scores["image_id"], scores["score"]
+
+
+def cell_values(matrix, rows, cols):
+    # значения клеток разреженной матрицы, пустые - ноль
+    return np.asarray(matrix[rows, cols], dtype=np.float32).ravel()
+
+
+def similarity_workers():
+    # 0 в настройке - по числу ядер
+    return settings.COLAB_FILTER_WORKERS or os.cpu_count() or 1
+
+
+def neighbour_index(normed, k):
+    # top-k соседей каждой строки normed по косинусу, в памяти держим только их
+    rows_count = normed.shape[0]
+    block = max(1, BLOCK_ELEMENTS // rows_count)
+    workers = similarity_workers()
+    if workers < 2 or rows_count < PARALLEL_MIN_ROWS:
+        return neighbour_rows(normed, normed.T.tocsc(), 0, rows_count, k, block)
+
+    # части строк считаются параллельно, каждый процесс получает матрицу один раз при запуске;
+    # spawn, потому что пересборка идет в потоке, а fork из многопоточного процесса небезопасен
+    neighbours = np.full((rows_count, k), -1, dtype=np.int32)
+    neighbour_sims = np.zeros((rows_count, k), dtype=np.float32)
+    shard = max(block, -(-rows_count // (workers * 4)))
+    starts = list(range(0, rows_count, shard))
+    stops = [min(start + shard, rows_count) for start in starts]
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(normed,)
+    ) as pool:
+        for start, stop, (top, top_sims) in zip(
+            starts, stops, pool.map(worker_neighbour_rows, starts, stops, repeat(k), repeat(block))
+        ):
+            neighbours[start:stop], neighbour_sims[start:stop] = top, top_sims
+    return neighbours, neighbour_sims
+
+
+class GrowingRows():
+    # строки модели по челикам: собранные - общий массив (mmap слепка, при записи копируются только
+    # измененные страницы), новые после сборки - отдельный небольшой массив с запасом
+    def __init__(self, base, fill=0):
+        self.base = base
+        self.fill = fill
+        self.extra = np.full((0, *base.shape[1:]), fill, dtype=base.dtype)
+        self.count = len(base)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def shape(self):
+        return (self.count, *self.base.shape[1:])
+
+    def __array__(self, dtype=None, copy=None):
+        # склеенная копия только если есть новые строки
+        array = self.base if self.count == len(self.base) else np.concatenate([self.base, self.extra[:self.count - len(self.base)]])
+        return array if dtype is None else array.astype(dtype)
+
+    def __iter__(self):
+        return (self[row] for row in range(self.count))
+
+    def copy(self):
+        return np.array(self)
+
+    def resize(self, count):
+        extra_count = count - len(self.base)
+        if extra_count > len(self.extra):
+            capacity = max(extra_count, 2 * len(self.extra), 16)
+            self.extra = np.concatenate([
+                self.extra,
+                np.full((capacity - len(self.extra), *self.base.shape[1:]), self.fill, dtype=self.base.dtype),
+            ])
+        self.count = max(self.count, count)
+
+    def __getitem__(self, rows):
+        if np.isscalar(rows):
+            return self.base[rows] if rows < len(self.base) else self.extra[rows - len(self.base)]
+        rows = np.asarray(rows, dtype=np.int64)
+        result = np.empty((len(rows), *self.base.shape[1:]), dtype=self.base.dtype)
+        in_base = rows < len(self.base)
+        result[in_base] = self.base[rows[in_base]]
+        result[~in_base] = self.extra[rows[~in_base] - len(self.base)]
+        return result
+
+    def __setitem__(self, rows, values):
+        if np.isscalar(rows):
+            if rows < len(self.base):
+                self.base[rows] = values
+            else:
+                self.extra[rows - len(self.base)] = values
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        values = np.asarray(values)
+        in_base = rows < len(self.base)
+        self.base[rows[in_base]] = values[in_base]
+        self.extra[rows[~in_base] - len(self.base)] = values[~in_base]
+
+
+class StagedMatrix():
+    # разреженная матрица суммой двух частей: правки прибавляются к маленькой recent, в большую merged
+    # она сливается, когда дорастет до четверти, так что правка стоит пропорционально своему размеру
+    def __init__(self, shape):
+        self.merged = sparse.csr_matrix(shape, dtype=np.float32)
+        self.recent = sparse.csr_matrix(shape, dtype=np.float32)
+
+    @property
+    def shape(self):
+        return self.merged.shape
+
+    def resize(self, rows_count, cols_count):
+        def grown(matrix):
+            indptr = np.pad(matrix.indptr, (0, rows_count + 1 - len(matrix.indptr)), mode="edge")
+            return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=(rows_count, cols_count), copy=False)
+        self.merged, self.recent = grown(self.merged), grown(self.recent)
+
+    def add(self, change):
+        self.recent = (self.recent + change).tocsr()
+        if self.recent.nnz * 4 > self.merged.nnz + 1024:
+            self.merged = (self.merged + self.recent).tocsr()
+            self.recent = sparse.csr_matrix(self.shape, dtype=np.float32)
+
+    def left_product(self, vectors):
+        return vectors @ self.merged + vectors @ self.recent
+
+
+class ColabModel():
+    # user-user косинус: предсказание по оценкам top-k похожих челиков
+    backend = "cosine"
+
     def __init__(self):
+        # id профилей и картинок по номеру строки/столбца и обратно
         self.image_ids = None
         self.user_ids = None
+        self.image_index = None
+        self.user_index = None
+        # оценки на момент сборки, после сборки не меняются и могут быть общими для процессов
         self.raw_data = None
+        self.raw_mask = None
         self.data = None
-        self.cosine = None
-        if self.update_data_from_db():
-            self.update_cosine()
-        self.update_timer = time.time()
-        self.image_count = Image.objects.count()
+        # обратные длины строк data, для схожести с обновленными челиками
+        self.inv_mag = None
+        # оценки после сборки: {строка: {столбец: оценка}}, поверх raw_data
+        self.overlay = {}
+        self.overlay_cells = 0
+        # разница overlay с raw_data: прибавка к оценкам и к числу оценивших, обновляется пачками
+        self.score_delta = None
+        self.count_delta = None
+        # нормированные вектора вкусов челиков из overlay: {строка: (столбцы, значения)} и они же
+        # транспонированной матрицей картинка-челик, схожесть с ними считается только по общим картинкам
+        self.centred_rows = {}
+        self.centred_t = None
+        self.overlay_rows = np.zeros(0, dtype=np.int64)
+        # top-k похожих профилей для каждой строки, -1 - пустая ячейка
+        self.neighbours = None
+        self.neighbour_sims = None
+        self.built_at = time.time()
+        self.build_time = 0
+        # имя поколения слепка, из которого загружена или в которое сохранена модель
+        self.generation = None
+        # последняя оценка, попавшая в модель: {"id": ..., "datetime": ...}
+        self.watermark = {"id": 0, "datetime": None}
+        # заблокированные на момент сборки картинки, чтобы заметить разблокировку
+        self.blocked_ids = set()
+        # столбцы картинок от самых популярных: для новых челиков и когда предсказать нечего
+        self.popular = np.zeros(0, dtype=np.int32)
+        # жалобы и маска скрытых картинок по столбцам, модерация меняет их сразу, без пересборки
+        self.report_counts = np.zeros(0, dtype=np.int32)
+        self.excluded = np.zeros(0, dtype=bool)
+        # правки оценок и чтение в predict не должны пересекаться
+        self.lock = RLock()
+
+    @classmethod
+    def build(cls, previous=None):
+        start = time.time()
+        model = cls()
+        if not model.update_data_from_db(previous):
+            return
+        model.update_reports()
+        model.update_popular()
+        model.fit()
+        model.built_at = time.time()
+        model.build_time = model.built_at - start
+        return model
 
     @timeit
-    def update_data_from_db(self):
+    def update_data_from_db(self, previous=None):
         score_data = ImageScore.objects.exclude(image__in=ImageBlock.objects.values("image"))
-        if not score_data:
+        # отметка берется до чтения: оценки, пришедшие во время чтения, догонятся повторно
+        watermark = ImageScore.objects.aggregate(id=Max("id"), datetime=Max("datetime"))
+        blocked_ids = set(ImageBlock.objects.values_list("image_id", flat=True))
+        if previous is not None and previous.watermark["id"]:
+            scores = self.merge_from_db(previous, blocked_ids)
+            # если что-то удалили в обход отметки, число клеток разойдется с базой
+            if len(scores[0]) != score_data.count():
+                logging.info("ColabFilter delta load does not match database, full reload")
+                scores = None
+        else:
+            scores = None
+        if scores is None:
+            scores = read_scores(score_data)
+        if not len(scores[0]):
             return
-        df = pd.DataFrame(list(score_data.values("profile_id", "image_id", "score")))
-        df = df.pivot_table(columns='image_id', index='profile_id', values='score').reset_index()
-        data = df.to_numpy(dtype=np.float16)[:, 1:]
-        self.image_ids = df.columns.values.tolist()[1:]
-        self.user_ids = df.profile_id.tolist()
-        self.raw_data = np.nan_to_num(data)
-
-        # нормализовать и заполнить пустые нулями
-        masked_data = ma.masked_invalid(data, copy=False)
-        ma_average = ma.average(masked_data, axis=1)
-        masked_data = (masked_data.transpose() - ma_average).transpose()
-        self.data = masked_data.filled(fill_value=0)
+
+        self.load_scores(*scores)
+        self.watermark = watermark
+        self.blocked_ids = blocked_ids
         return True
 
+    def merge_from_db(self, previous, blocked_ids):
+        # оценки прошлой модели вместе с overlay, поверх них изменения после ее отметки
+        with previous.lock:
+            user_ids = previous.user_ids
+            image_ids = previous.image_ids
+            base = previous.raw_data.tocoo()
+            overlay = [(row, col, score) for row, cells in previous.overlay.items() for col, score in cells.items()]
+        changed = [
+            read_scores(self.newer_scores(previous.watermark).exclude(image__in=blocked_ids)),
+            # разблокированные картинки возвращаются со всеми оценками
+            read_scores(ImageScore.objects.filter(image__in=previous.blocked_ids - blocked_ids)),
+        ]
+        overlay = np.array(overlay, dtype=np.int64).reshape(-1, 3)
+        profile_ids = np.concatenate([user_ids[base.row], user_ids[overlay[:, 0]], *(c[0] for c in changed)])
+        image_ids = np.concatenate([image_ids[base.col], image_ids[overlay[:, 1]], *(c[1] for c in changed)])
+        scores = np.concatenate([base.data.astype(np.int8), overlay[:, 2].astype(np.int8), *(c[2] for c in changed)])
+
+        # у клетки остается последняя оценка
+        cells = profile_ids * (image_ids.max(initial=0) + 1) + image_ids
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(scores) - 1 - last
+        profile_ids, image_ids, scores = profile_ids[last], image_ids[last], scores[last]
+
+        # картинки, которые заблокировали или удалили после прошлой сборки
+        existing = np.fromiter(Image.objects.values_list("id", flat=True), dtype=np.int64)
+        keep = np.isin(image_ids, existing) & ~np.isin(image_ids, list(blocked_ids))
+        return profile_ids[keep], image_ids[keep], scores[keep]
+
+    def load_scores(self, profile_ids, image_ids, scores):
+        user_ids, rows = np.unique(profile_ids, return_inverse=True)
+        image_ids, cols = np.unique(image_ids, return_inverse=True)
+        self.set_ids(user_ids, image_ids)
+        # разреженная матрица челик-картинка, пустые клетки не хранятся
+        self.raw_data = sparse.csr_matrix(
+            (scores.astype(np.float32), (rows.astype(np.int32), cols.astype(np.int32))),
+            shape=(len(user_ids), len(image_ids)),
+        )
+        self.raw_mask = self.mask(self.raw_data)
+
+        # нормализовать только заполненные клетки, пустые остаются нулями
+        self.data = self.centered(self.raw_data)
+        # пока популярность не посчитана, сначала новые картинки
+        self.popular = np.arange(len(image_ids) - 1, -1, -1, dtype=np.int32)
+        self.report_counts = np.zeros(len(image_ids), dtype=np.int32)
+        self.excluded = np.zeros(len(image_ids), dtype=bool)
+        self.reset_overlay()
+
+    def reset_overlay(self):
+        shape = self.raw_data.shape
+        self.overlay = {}
+        self.overlay_cells = 0
+        self.score_delta = sparse.csr_matrix(shape, dtype=np.float32)
+        self.count_delta = sparse.csr_matrix(shape, dtype=np.float32)
+        self.centred_rows = {}
+        self.centred_t = StagedMatrix(shape[::-1])
+        self.overlay_rows = np.zeros(0, dtype=np.int64)
+
+    def loaded_columns(self, image_ids):
+        # столбцы для id картинок сразу после загрузки, пока image_ids отсортированы
+        cols = np.searchsorted(self.image_ids, image_ids).clip(max=max(len(self.image_ids) - 1, 0))
+        return cols, self.image_ids[cols] == image_ids
+
     @timeit
-    def update_score(self, image_score):
-        if image_score.profile.id not in self.user_ids or image_score.image.id not in self.image_ids:
+    def update_reports(self):
+        reports = np.fromiter(
+            Report.objects.values_list("image_id", flat=True).iterator(chunk_size=LOAD_CHUNK), dtype=np.int64
+        )
+        cols, known = self.loaded_columns(reports)
+        self.report_counts = np.bincount(cols[known], minlength=len(self.image_ids)).astype(np.int32)
+        self.excluded = self.report_counts >= REPORT_LIMIT
+
+    def update_moderation(self, blocked_ids):
+        # жалобы из базы, заблокированные и удаленные после сборки картинки скрываются
+        self.update_reports()
+        existing = np.fromiter(
+            Image.objects.values_list("id", flat=True).iterator(chunk_size=LOAD_CHUNK), dtype=np.int64
+        )
+        deleted = self.image_ids[~np.isin(self.image_ids, existing)]
+        self.exclude_images(blocked_ids | set(deleted.tolist()))
+        self.blocked_ids = blocked_ids
+
+    def exclude_images(self, image_ids):
+        # заблокированные и удаленные картинки
+        with self.lock:
+            cols = [self.image_index[image_id] for image_id in image_ids if image_id in self.image_index]
+            self.excluded[cols] = True
+
+    def report_images(self, image_ids):
+        with self.lock:
+            for image_id in image_ids:
+                if (col := self.image_index.get(image_id)) is not None:
+                    self.report_counts[col] += 1
+                    self.excluded[col] |= self.report_counts[col] >= REPORT_LIMIT
+
+    @timeit
+    def update_popular(self):
+        # лайки других челиков с затуханием по времени минус жалобы
+        now = datetime_now()
+        likes = np.fromiter(
+            (
+                (image_id, (now - score_datetime).total_seconds(), score)
+                for image_id, score_datetime, score in ImageScore.objects
+                    .filter(score__gt=0, datetime__gte=now - datetime.timedelta(days=POPULAR_DAYS))
+                    .exclude(profile=F("image__profile"))
+                    .values_list("image_id", "datetime", "score")
+                    .iterator(chunk_size=LOAD_CHUNK)
+            ),
+            dtype=[("image_id", np.int64), ("age", np.float64), ("score", np.int8)],
+        )
+        half_life = POPULAR_HALF_LIFE * 24 * 60 * 60
+        cols, known = self.loaded_columns(likes["image_id"])
+        popularity = np.bincount(
+            cols[known], weights=likes["score"][known] * 0.5 ** (likes["age"][known] / half_life),
+            minlength=len(self.image_ids),
+        ) - REPORT_WEIGHT * self.report_counts
+        # при равной популярности сначала новые картинки
+        self.popular = np.lexsort((-self.image_ids, -popularity)).astype(np.int32)
+
+    def popular_images(self, count, seen=()):
+        # первые count популярных картинок без уже оцененных, обычно хватает первой порции
+        result = []
+        seen = np.asarray(list(seen), dtype=np.int64)
+        for start in range(0, len(self.popular), 2 * count):
+            cols = self.popular[start:start + 2 * count]
+            result.extend(cols[~np.isin(cols, seen) & ~self.excluded[cols]].tolist())
+            if len(result) >= count:
+                break
+        return [{"taste_similarity": 0, "image_id": int(self.image_ids[col])} for col in result[:count]]
+
+    def set_ids(self, user_ids, image_ids):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.image_ids = np.asarray(image_ids, dtype=np.int64)
+        self.user_index = dict(zip(self.user_ids.tolist(), range(len(self.user_ids))))
+        self.image_index = dict(zip(self.image_ids.tolist(), range(len(self.image_ids))))
+
+    def user_rows(self, profile_ids):
+        # номера строк для списка id, -1 для неизвестных
+        return np.fromiter((self.user_index.get(profile_id, -1) for profile_id in profile_ids), np.int64, len(profile_ids))
+
+    @staticmethod
+    def mask(raw_data):
+        return sparse.csr_matrix(
+            (np.ones_like(raw_data.data), raw_data.indices, raw_data.indptr), shape=raw_data.shape, copy=False
+        )
+
+    def arrays(self):
+        return {
+            "user_ids": self.user_ids,
+            "image_ids": self.image_ids,
+            "blocked_ids": np.array(sorted(self.blocked_ids), dtype=np.int64),
+            "popular": self.popular,
+            "report_counts": self.report_counts,
+            "excluded": self.excluded,
+            "raw_data_indptr": self.raw_data.indptr,
+            "raw_data_indices": self.raw_data.indices,
+            "raw_data_data": self.raw_data.data,
+            "raw_mask_data": self.raw_mask.data,
+            "data_indptr": self.data.indptr,
+            "data_indices": self.data.indices,
+            "data_data": self.data.data,
+            **self.fitted_arrays(),
+        }
+
+    def fitted_arrays(self):
+        return {
+            "inv_mag": self.inv_mag,
+            "neighbours": np.asarray(self.neighbours),
+            "neighbour_sims": np.asarray(self.neighbour_sims),
+        }
+
+    def load_fitted(self, arrays):
+        self.inv_mag = arrays["inv_mag"]
+        self.neighbours = GrowingRows(arrays["neighbours"], fill=-1)
+        self.neighbour_sims = GrowingRows(arrays["neighbour_sims"])
+
+    @timeit
+    def save(self, root):
+        # каждая пересборка пишется в новое поколение, воркеры переключаются по файлу CURRENT
+        root = Path(root)
+        generation = str(int(self.built_at * 1000))
+        tmp_path = root / f"{generation}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        with self.lock:
+            for name, array in self.arrays().items():
+                np.save(tmp_path / f"{name}.npy", array)
+            meta = {
+                "version": SNAPSHOT_VERSION,
+                "backend": self.backend,
+                "built_at": self.built_at,
+                "build_time": self.build_time,
+                "shape": self.raw_data.shape,
+                "watermark": {
+                    "id": self.watermark["id"],
+                    "datetime": self.watermark["datetime"].isoformat() if self.watermark["datetime"] else None,
+                },
+            }
+        (tmp_path / "meta.json").write_text(json.dumps(meta))
+        shutil.rmtree(root / generation, ignore_errors=True)
+        tmp_path.rename(root / generation)
+        (root / "CURRENT.tmp").write_text(generation)
+        os.replace(root / "CURRENT.tmp", root / "CURRENT")
+        self.generation = generation
+
+        # старые поколения удаляются, уже открытые воркерами mmap остаются валидными
+        generations = sorted(
+            (path for path in root.iterdir() if path.is_dir() and path.name.isdigit()),
+            key=lambda path: int(path.name),
+        )
+        for path in generations[:-SNAPSHOT_GENERATIONS]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def current_generation(root):
+        try:
+            return (Path(root) / "CURRENT").read_text().strip() or None
+        except OSError:
             return
-        profile_index = self.user_ids.index(image_score.profile.id)
-        image_index = self.image_ids.index(image_score.image.id)
 
-        self.raw_data[profile_index, image_index] = image_score.score
-        return True
+    @classmethod
+    @timeit
+    def load(cls, root):
+        if not (generation := cls.current_generation(root)):
+            return
+        path = Path(root) / generation
+        try:
+            meta = json.loads((path / "meta.json").read_text())
+        except (OSError, ValueError):
+            return
+        if meta.get("version") != SNAPSHOT_VERSION:
+            logging.info(f"ColabFilter snapshot {path} has version {meta.get('version')}, ignored")
+            return
+        if meta.get("backend", ColabModel.backend) != cls.backend:
+            logging.info(f"ColabFilter snapshot {path} has backend {meta.get('backend')}, ignored")
+            return
+        # copy-on-write: страницы общие для всех процессов через page cache,
+        # в память процесса копируются только строки соседей, обновленные update_score
+        arrays = {
+            file.stem: np.load(file, mmap_mode="c")
+            for file in path.glob("*.npy")
+        }
+        model = cls()
+        model.generation = generation
+        model.set_ids(arrays["user_ids"], arrays["image_ids"])
+        model.blocked_ids = set(arrays["blocked_ids"].tolist())
+        model.popular = arrays["popular"]
+        model.report_counts = arrays["report_counts"]
+        model.excluded = arrays["excluded"]
+        shape = tuple(meta["shape"])
+        model.raw_data = sparse.csr_matrix(
+            (arrays["raw_data_data"], arrays["raw_data_indices"], arrays["raw_data_indptr"]), shape=shape, copy=False
+        )
+        model.raw_mask = sparse.csr_matrix(
+            (arrays["raw_mask_data"], arrays["raw_data_indices"], arrays["raw_data_indptr"]), shape=shape, copy=False
+        )
+        model.data = sparse.csr_matrix(
+            (arrays["data_data"], arrays["data_indices"], arrays["data_indptr"]), shape=shape, copy=False
+        )
+        model.load_fitted(arrays)
+        model.reset_overlay()
+        model.built_at = meta["built_at"]
+        model.build_time = meta["build_time"]
+        model.watermark = {
+            "id": meta["watermark"]["id"],
+            "datetime": datetime.datetime.fromisoformat(meta["watermark"]["datetime"])
+            if meta["watermark"]["datetime"] else None,
+        }
+        return model
+
+    @staticmethod
+    def newer_scores(watermark):
+        # новые оценки по id, измененные - по дате взаимодействия
+        newer = Q(id__gt=watermark["id"] or 0)
+        if watermark["datetime"]:
+            newer |= Q(datetime__gt=watermark["datetime"])
+        return ImageScore.objects.filter(newer)
 
     @timeit
-    def update_cosine(self):
-        # построить матрицу челик-челик
-        similarity = np.dot(self.data, self.data.T)
+    def catch_up(self):
+        # досылает оценки новее отметки и модерацию после сборки, возвращает число оценок
+        new_scores = self.newer_scores(self.watermark)
+        watermark = new_scores.aggregate(id=Max("id"), datetime=Max("datetime"))
+        blocked_ids = set(ImageBlock.objects.values_list("image_id", flat=True))
+        unblocked = self.blocked_ids - blocked_ids
+        # пока столбцы отсортированы по id картинок, до дописывания новых
+        self.update_moderation(blocked_ids)
+        # одна пачка: дельты обновляются одним сложением, строки соседей пересчитываются блоками
+        profile_ids, image_ids, scores = (np.concatenate(parts) for parts in zip(
+            read_scores(new_scores.exclude(image__in=ImageBlock.objects.values("image"))),
+            # разблокированные картинки возвращаются со всеми оценками
+            read_scores(ImageScore.objects.filter(image__in=unblocked)),
+        ))
+        caught_up = self.apply_scores(list(zip(profile_ids.tolist(), image_ids.tolist(), scores.tolist())))
+        self.watermark = {
+            "id": max(self.watermark["id"], watermark["id"] or 0),
+            "datetime": max(filter(None, [self.watermark["datetime"], watermark["datetime"]]), default=None),
+        }
+        return caught_up
 
-        # squared magnitude of preference vectors (number of occurrences)
-        square_mag = np.diag(similarity)
+    @staticmethod
+    def centered(raw_data):
+        counts = np.diff(raw_data.indptr)
+        average = np.asarray(raw_data.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        data = raw_data.copy()
+        data.data -= np.repeat(average, counts).astype(data.dtype)
+        data.eliminate_zeros()
+        return data
 
-        # inverse squared magnitude
-        inv_square_mag = 1 / square_mag
+    def update_score(self, profile_id, image_id, score):
+        return self.apply_scores([(profile_id, image_id, score)])
 
-        # if it doesn't occur, set it's inverse magnitude to zero (instead of inf)
-        inv_square_mag[np.isinf(inv_square_mag)] = 0
+    def apply_scores(self, scores):
+        if not scores:
+            return 0
+        with self.lock:
+            # новые челики и картинки дописываются в конец, матрицы растут без копирования оценок
+            new_users = [profile_id for profile_id in dict.fromkeys(s[0] for s in scores) if profile_id not in self.user_index]
+            new_images = [image_id for image_id in dict.fromkeys(s[1] for s in scores) if image_id not in self.image_index]
+            if new_users or new_images:
+                self.user_index.update(zip(new_users, range(len(self.user_ids), len(self.user_ids) + len(new_users))))
+                self.image_index.update(zip(new_images, range(len(self.image_ids), len(self.image_ids) + len(new_images))))
+                self.user_ids = np.concatenate([self.user_ids, np.array(new_users, dtype=np.int64)])
+                self.image_ids = np.concatenate([self.image_ids, np.array(new_images, dtype=np.int64)])
+                self.resize(len(self.user_ids), len(self.image_ids))
 
-        # inverse of the magnitude
-        inv_mag = np.sqrt(inv_square_mag)
+            # у клетки остается последняя оценка пачки
+            cells = {}
+            for profile_id, image_id, score in scores:
+                cells[self.user_index[profile_id], self.image_index[image_id]] = score
+            # строки overlay остаются отсортированными, новые вставляются на свои места
+            new_rows = np.array(sorted({row for row, _ in cells if row not in self.overlay}), dtype=np.int64)
+            self.overlay_rows = np.insert(self.overlay_rows, np.searchsorted(self.overlay_rows, new_rows), new_rows)
+            for (row, col), score in cells.items():
+                row_cells = self.overlay.setdefault(row, {})
+                self.overlay_cells += col not in row_cells
+                row_cells[col] = score
+            rows = np.fromiter((row for row, _ in cells), np.int64, len(cells))
+            cols = np.fromiter((col for _, col in cells), np.int64, len(cells))
+            self.update_deltas(rows, cols, np.fromiter(cells.values(), np.float32, len(cells)))
+            self.refresh_users(np.unique(rows))
+        return len(scores)
 
-        # cosine similarity (elementwise multiply by inverse magnitudes)
-        cosine = similarity * inv_mag
-        self.cosine = cosine.T * inv_mag
+    def update_deltas(self, rows, cols, scores):
+        # в дельты добавляется только разница с их прошлым значением в клетках пачки
+        shape = self.raw_data.shape
+        score_change = scores - cell_values(self.raw_data, rows, cols) - cell_values(self.score_delta, rows, cols)
+        count_change = 1 - cell_values(self.raw_mask, rows, cols) - cell_values(self.count_delta, rows, cols)
+        self.score_delta = (self.score_delta + sparse.csr_matrix((score_change, (rows, cols)), shape=shape)).tocsr()
+        self.count_delta = (self.count_delta + sparse.csr_matrix((count_change, (rows, cols)), shape=shape)).tocsr()
 
-    def get_similar_profiles(self, target_profile_id):
-        profile_index = self.user_ids.index(target_profile_id)
-        last_dislikes = ImageScore.last_dislikes(target_profile_id)
-        users = np.setdiff1d(
-            np.where(self.cosine[profile_index] > 0),
-            np.array([self.user_ids.index(profile_id) for profile_id in last_dislikes])
+    def resize(self, users_count, images_count):
+        def grown(matrix):
+            indptr = matrix.indptr
+            if users_count + 1 > len(indptr):
+                indptr = np.concatenate([indptr, np.full(users_count + 1 - len(indptr), indptr[-1], dtype=indptr.dtype)])
+            return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=(users_count, images_count), copy=False)
+
+        self.raw_data = grown(self.raw_data)
+        self.raw_mask = grown(self.raw_mask)
+        self.data = grown(self.data)
+        self.score_delta = grown(self.score_delta)
+        self.count_delta = grown(self.count_delta)
+        self.centred_t.resize(images_count, users_count)
+        self.report_counts = np.pad(self.report_counts, (0, images_count - len(self.report_counts)))
+        self.excluded = np.pad(self.excluded, (0, images_count - len(self.excluded)))
+        self.resize_fitted(users_count, images_count)
+
+    def resize_fitted(self, users_count, images_count):
+        # inv_mag не растет: у новых челиков в data пустые строки, их схожесть берется из centred
+        self.neighbours.resize(users_count)
+        self.neighbour_sims.resize(users_count)
+
+    def user_row(self, row):
+        start, stop = self.raw_data.indptr[row:row + 2]
+        cells = dict(zip(self.raw_data.indices[start:stop].tolist(), self.raw_data.data[start:stop].tolist()))
+        cells.update(self.overlay.get(row, {}))
+        return np.fromiter(cells.keys(), np.int64, len(cells)), np.fromiter(cells.values(), np.float32, len(cells))
+
+    def refresh_users(self, rows):
+        # пересчитать строки соседей челиков, схожесть блока строк - одно разреженное произведение
+        normed = self.centre_rows(rows)
+        k = self.neighbours.shape[1]
+        block = max(1, BLOCK_ELEMENTS // len(self.user_ids))
+        for start in range(0, len(rows), block):
+            block_rows = rows[start:start + block]
+            top, top_sims = top_neighbours(
+                self.similarities(normed[start:start + block]), block_rows - np.arange(len(block_rows)), k
+            )
+            self.neighbours[block_rows], self.neighbour_sims[block_rows] = top, top_sims
+
+    def effective_rows(self, rows):
+        # оценки строк с учетом overlay; нулевых оценок не бывает, нули - пустые клетки
+        effective = (self.raw_data[rows] + self.score_delta[rows]).tocsr()
+        effective.eliminate_zeros()
+        return effective
+
+    def normed_rows(self, rows):
+        centred = self.centered(self.effective_rows(rows))
+        return (sparse.diags(self.inverse_norms(centred)) @ centred).tocsr()
+
+    def centre_rows(self, rows):
+        # в centred_t к старым векторам челиков прибавляется разница с новыми
+        normed = self.normed_rows(rows)
+        placed = normed.tocoo()
+        cols, users, values = [placed.col], [rows[placed.row]], [placed.data]
+        for pos, row in enumerate(rows.tolist()):
+            if (old := self.centred_rows.get(row)) is not None:
+                cols.append(old[0])
+                users.append(np.full(len(old[0]), row))
+                values.append(-old[1])
+            start, stop = normed.indptr[pos:pos + 2]
+            self.centred_rows[row] = (normed.indices[start:stop], normed.data[start:stop])
+        self.centred_t.add(sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(cols), np.concatenate(users))), shape=self.centred_t.shape
+        ))
+        return normed
+
+    def similarities(self, vectors):
+        # косинус нормированных строк vectors со всеми челиками, челики из overlay берутся из centred_t
+        if vectors.shape[0] < DENSE_SIMILARITY_ROWS:
+            sims = (self.data @ vectors.T.toarray()).T
+        else:
+            sims = (self.data @ vectors.T).T.toarray()
+        sims[:, :len(self.inv_mag)] *= self.inv_mag
+        sims[:, self.overlay_rows] = 0
+        sims += self.centred_t.left_product(vectors).toarray()
+        return sims
+
+    def fit(self):
+        self.update_cosine()
+
+    @staticmethod
+    def inverse_norms(data, axis=1):
+        # обратные длины строк (axis=1) или столбцов (axis=0), у пустых векторов ноль вместо inf
+        magnitude = np.sqrt(np.asarray(data.multiply(data).sum(axis=axis)).ravel())
+        inv_mag = np.zeros_like(magnitude)
+        np.divide(1, magnitude, out=inv_mag, where=magnitude != 0)
+        return inv_mag.astype(np.float32)
+
+    @timeit
+    def update_cosine(self, lsh_tables=None, lsh_bits=None):
+        self.inv_mag = self.inverse_norms(self.data)
+        normed = (sparse.diags(self.inv_mag) @ self.data).tocsr()
+
+        k = NEIGHBOURS_COUNT
+        lsh_tables = settings.COLAB_FILTER_LSH_TABLES if lsh_tables is None else lsh_tables
+        if not lsh_tables:
+            neighbours, neighbour_sims = neighbour_index(normed, k)
+        else:
+            users_count = normed.shape[0]
+            neighbours = np.full((users_count, k), -1, dtype=np.int32)
+            neighbour_sims = np.zeros((users_count, k), dtype=np.float32)
+            self.update_lsh_neighbours(
+                normed, neighbours, neighbour_sims, lsh_tables,
+                settings.COLAB_FILTER_LSH_BITS if lsh_bits is None else lsh_bits,
+            )
+        self.neighbours = GrowingRows(neighbours, fill=-1)
+        self.neighbour_sims = GrowingRows(neighbour_sims)
+
+    @timeit
+    def update_lsh_neighbours(self, normed, neighbours, neighbour_sims, tables, bits, seed=0):
+        # случайные гиперплоскости: у похожих векторов совпадает больше знаков проекций,
+        # точный косинус считается только для челиков из одной корзины
+        rng = np.random.default_rng(seed)
+        images_count = normed.shape[1]
+        k = neighbours.shape[1]
+        has_taste = np.flatnonzero(self.inv_mag)
+        weights = 1 << np.arange(bits, dtype=np.int64)
+        for _ in range(tables):
+            planes = rng.standard_normal((images_count, bits)).astype(np.float32)
+            codes = ((normed[has_taste] @ planes) > 0) @ weights
+            shuffled = rng.permutation(len(has_taste))
+            order = shuffled[np.argsort(codes[shuffled], kind="stable")]
+            users, codes = has_taste[order], codes[order]
+            bounds = np.flatnonzero(np.diff(codes)) + 1
+            # каждый челик попадает в одну корзину таблицы, кандидаты пишутся в его строку
+            candidates = np.full_like(neighbours, -1)
+            candidate_sims = np.zeros_like(neighbour_sims)
+            for bucket in np.split(users, bounds):
+                for start in range(0, len(bucket), LSH_BUCKET):
+                    members = bucket[start:start + LSH_BUCKET]
+                    if len(members) < 2:
+                        continue
+                    block = normed[members]
+                    top, top_sims = top_neighbours((block @ block.T).toarray(), 0, min(k, len(members)))
+                    width = top.shape[1]
+                    candidates[members, :width] = np.where(top >= 0, members[top], -1)
+                    candidate_sims[members, :width] = top_sims
+            merge_neighbours(neighbours, neighbour_sims, candidates, candidate_sims, max(1, BLOCK_ELEMENTS // (2 * k)))
+
+    def neighbour_weights(self, profile_indexes, profile_ids, last_dislikes):
+        # строка на каждого челика: веса похожих профилей без недавно дизлайкнутых авторов
+        neighbours = self.neighbours[profile_indexes]
+        sims = self.neighbour_sims[profile_indexes].copy()
+        for row, profile_id in enumerate(profile_ids):
+            disliked = self.user_rows(list(last_dislikes.get(profile_id, ())))
+            sims[row, np.isin(neighbours[row], disliked)] = 0
+        valid = (neighbours >= 0) & (sims > 0)
+        return sparse.csr_matrix(
+            (sims[valid], (np.nonzero(valid)[0], neighbours[valid])),
+            shape=(len(profile_ids), len(self.user_ids)),
         )
-        return users
+
+    def get_similar_profiles(self, target_profile_id, last_dislikes=None):
+        if last_dislikes is None:
+            last_dislikes = ImageScore.last_dislikes_many([target_profile_id])
+        with self.lock:
+            profile_index = self.user_index[target_profile_id]
+            return self.neighbour_weights([profile_index], [target_profile_id], last_dislikes).indices
+
+    def predict(self, target_profile_id, count=50, last_dislikes=None):
+        return self.predict_many([target_profile_id], count, last_dislikes)[target_profile_id]
+
+    def predict_many(self, profile_ids, count=50, last_dislikes=None):
+        # новые челики еще ничего не оценили, им целая страница популярного
+        popular = self.popular_images(count)
+        predictions = {
+            profile_id: list(popular) for profile_id in profile_ids if profile_id not in self.user_index
+        }
+        profile_ids = [profile_id for profile_id in profile_ids if profile_id not in predictions]
+        if not profile_ids:
+            return predictions
+
+        if last_dislikes is None:
+            last_dislikes = ImageScore.last_dislikes_many(profile_ids)
+        predictions.update(self.rank(profile_ids, count, last_dislikes))
+        for profile_id in profile_ids:
+            page = predictions[profile_id]
+            if len(page) < count:
+                # похожие челики предложили меньше страницы: остаток - популярное без оцененного и уже предложенного
+                with self.lock:
+                    seen = self.user_row(self.user_index[profile_id])[0]
+                offered = {prediction["image_id"] for prediction in page}
+                page.extend([
+                    prediction for prediction in self.popular_images(count, seen) if prediction["image_id"] not in offered
+                ][:count - len(page)])
+        return predictions
+
+    def rank(self, profile_ids, count, last_dislikes):
+        predictions = {}
+        for start, prediction in self.prediction_blocks(profile_ids, last_dislikes):
+            # скрытые модерацией картинки не предлагаем
+            prediction[:, self.excluded[:prediction.shape[1]]] = -np.inf
+            top = min(count, prediction.shape[1])
+            top_items_pos = np.argpartition(-prediction, top - 1, axis=1)[:, :top]
+            for row, profile_id in enumerate(profile_ids[start:start + len(prediction)]):
+                row_top = top_items_pos[row][np.argsort(-prediction[row, top_items_pos[row]], kind="stable")]
+                predictions[profile_id] = [
+                    {
+                        "taste_similarity": prediction[row, item_pos],
+                        "image_id": int(self.image_ids[item_pos]),
+                    } for item_pos in row_top if prediction[row, item_pos] != -np.inf
+                ]
+        return predictions
+
+    def prediction_blocks(self, profile_ids, last_dislikes):
+        # плотные блоки предсказаний по строкам profile_ids, уже оцененные картинки -inf
+        with self.lock:
+            profile_indexes = self.user_rows(profile_ids)
+            weights = self.neighbour_weights(profile_indexes, profile_ids, last_dislikes)
+            weights_mask = self.mask(weights)
+            score_delta, count_delta = self.score_delta, self.count_delta
+            # сумма оценок похожих челиков и число похожих челиков, оценивших картинку
+            scores = (weights @ self.raw_data + weights @ score_delta).tocsr()
+            counts = (weights_mask @ self.raw_mask + weights_mask @ count_delta).tocsr()
+            scored = (self.raw_mask[profile_indexes] + count_delta[profile_indexes]).astype(bool)
+
+        block = max(1, BLOCK_ELEMENTS // scores.shape[1])
+        for start in range(0, len(profile_ids), block):
+            stop = min(start + block, len(profile_ids))
+            block_counts = counts[start:stop].toarray()
+            prediction = scores[start:stop].toarray() / np.sqrt(block_counts + 1)
+            # картинки, которые не оценил ни один похожий челик, не кандидаты: их место займет популярное
+            prediction[(block_counts == 0) | scored[start:stop].toarray()] = -np.inf
+            yield start, prediction
+
+
+class FactorModel(ColabModel):
+    # усеченное SVD центрированных оценок: челик и картинка - векторы из FACTORS_COUNT чисел,
+    # предсказание - скалярное произведение, без обхода оценок похожих челиков
+    backend = "svd"
+
+    def __init__(self):
+        super().__init__()
+        self.user_factors = None
+        self.item_factors = None
+
+    def fit(self):
+        self.update_factors()
+
+    @timeit
+    def update_factors(self):
+        k = min(FACTORS_COUNT, min(self.data.shape) - 1)
+        if k < 1 or not self.data.nnz:
+            # разложить нечего, все предсказания нули
+            self.user_factors = GrowingRows(np.zeros((self.data.shape[0], 1), dtype=np.float32))
+            self.item_factors = np.zeros((self.data.shape[1], 1), dtype=np.float32)
+            return
+        u, s, vt = svds(self.data, k=k, random_state=0)
+        self.user_factors = GrowingRows((u * s).astype(np.float32))
+        self.item_factors = np.ascontiguousarray(vt.T, dtype=np.float32)
+
+    def fitted_arrays(self):
+        return {
+            "user_factors": np.asarray(self.user_factors),
+            "item_factors": self.item_factors,
+        }
+
+    def load_fitted(self, arrays):
+        self.user_factors = GrowingRows(arrays["user_factors"])
+        self.item_factors = arrays["item_factors"]
+
+    def resize_fitted(self, users_count, images_count):
+        # у новых картинок векторов нет до пересборки, предсказание по ним ноль, item_factors не растет
+        self.user_factors.resize(users_count)
+
+    def refresh_users(self, rows):
+        # fold-in: проекция центрированных оценок челиков на векторы картинок
+        centred = self.centered(self.effective_rows(rows))
+        self.user_factors[rows] = centred[:, :len(self.item_factors)] @ self.item_factors
+
+    def get_similar_profiles(self, target_profile_id, last_dislikes=None):
+        if last_dislikes is None:
+            last_dislikes = ImageScore.last_dislikes_many([target_profile_id])
+        with self.lock:
+            profile_index = self.user_index[target_profile_id]
+            user_factors = np.asarray(self.user_factors)
+            magnitude = np.linalg.norm(user_factors, axis=1)
+            sims = np.zeros(len(user_factors), dtype=np.float32)
+            np.divide(
+                user_factors @ user_factors[profile_index], magnitude * magnitude[profile_index],
+                out=sims, where=magnitude * magnitude[profile_index] != 0,
+            )
+        top, _ = top_neighbours(sims[np.newaxis, :], profile_index, NEIGHBOURS_COUNT)
+        disliked = self.user_rows(list(last_dislikes.get(target_profile_id, ())))
+        return top[0][(top[0] >= 0) & ~np.isin(top[0], disliked)]
+
+    def prediction_blocks(self, profile_ids, last_dislikes):
+        with self.lock:
+            profile_indexes = self.user_rows(profile_ids)
+            user_factors = self.user_factors[profile_indexes]
+            item_factors = self.item_factors
+            images_count = len(self.image_ids)
+            scored = (self.raw_mask[profile_indexes] + self.count_delta[profile_indexes]).astype(bool)
+
+        block = max(1, BLOCK_ELEMENTS // len(item_factors))
+        for start in range(0, len(profile_ids), block):
+            stop = min(start + block, len(profile_ids))
+            prediction = np.zeros((stop - start, images_count), dtype=np.float32)
+            prediction[:, :len(item_factors)] = user_factors[start:stop] @ item_factors.T
+            prediction[scored[start:stop].toarray()] = -np.inf
+            yield start, prediction
+
+
+class ItemModel(ColabModel):
+    # картинка-картинка: для каждой картинки top-k похожих по оценкам, кандидаты для челика -
+    # соседи его последних LIKED_COUNT лайков, цена запроса не зависит от размера каталога
+    backend = "item"
+
+    def __init__(self):
+        super().__init__()
+        self.item_neighbours = None
+        self.item_neighbour_sims = None
+
+    def fit(self):
+        self.update_item_neighbours()
+
+    @timeit
+    def update_item_neighbours(self):
+        # длины строк нужны get_similar_profiles, индекс соседей челиков не строится
+        self.inv_mag = self.inverse_norms(self.data)
+        normed = (self.data @ sparse.diags(self.inverse_norms(self.data, axis=0))).T.tocsr()
+        self.item_neighbours, self.item_neighbour_sims = neighbour_index(normed, NEIGHBOURS_COUNT)
+
+    def fitted_arrays(self):
+        return {
+            "inv_mag": self.inv_mag,
+            "item_neighbours": self.item_neighbours,
+            "item_neighbour_sims": self.item_neighbour_sims,
+        }
+
+    def load_fitted(self, arrays):
+        self.inv_mag = arrays["inv_mag"]
+        self.item_neighbours = arrays["item_neighbours"]
+        self.item_neighbour_sims = arrays["item_neighbour_sims"]
+
+    def resize_fitted(self, users_count, images_count):
+        # у новых картинок соседей нет до пересборки, индекс соседей не растет
+        pass
+
+    def refresh_users(self, rows):
+        self.centre_rows(rows)
+
+    def get_similar_profiles(self, target_profile_id, last_dislikes=None):
+        if last_dislikes is None:
+            last_dislikes = ImageScore.last_dislikes_many([target_profile_id])
+        with self.lock:
+            profile_index = self.user_index[target_profile_id]
+            sims = self.similarities(self.normed_rows([profile_index]))[0]
+        top, _ = top_neighbours(sims[np.newaxis, :], profile_index, NEIGHBOURS_COUNT)
+        disliked = self.user_rows(list(last_dislikes.get(target_profile_id, ())))
+        return top[0][(top[0] >= 0) & ~np.isin(top[0], disliked)]
+
+    def liked_images(self, row):
+        # последние лайки: сначала поставленные после сборки, затем по убыванию id картинки
+        indices, values = self.user_row(row)
+        recent = [col for col, score in reversed(self.overlay.get(row, {}).items()) if score > 0]
+        liked = np.sort(indices[values > 0])[::-1]
+        liked = np.fromiter(dict.fromkeys(recent + liked.tolist()), np.int64)[:LIKED_COUNT]
+        return liked, dict(zip(indices.tolist(), values.tolist()))
+
+    def rank(self, profile_ids, count, last_dislikes):
+        predictions = {}
+        for profile_id in profile_ids:
+            with self.lock:
+                liked, cells = self.liked_images(self.user_index[profile_id])
+                liked = liked[liked < len(self.item_neighbours)]
+                neighbours = self.item_neighbours[liked]
+                # сосед весит тем больше, чем выше оценка лайка, которому он похож
+                sims = self.item_neighbour_sims[liked] * np.array([cells[col] for col in liked.tolist()])[:, np.newaxis]
+            neighbours, sims = neighbours.ravel(), sims.ravel()
+            valid = (neighbours >= 0) & ~np.isin(neighbours, list(cells)) & ~self.excluded[neighbours]
+            items, inverse = np.unique(neighbours[valid], return_inverse=True)
+            scores = np.bincount(inverse, weights=sims[valid], minlength=len(items))
+            top = np.argsort(-scores, kind="stable")[:count]
+            predictions[profile_id] = [
+                {
+                    "taste_similarity": scores[pos],
+                    "image_id": int(self.image_ids[items[pos]]),
+                } for pos in top
+            ]
+        return predictions
+
+
+# движок рекомендаций выбирается настройкой COLAB_FILTER_BACKEND
+BACKENDS = {model.backend: model for model in (ColabModel, FactorModel, ItemModel)}
+
+
+class RecentDislikes():
+    # авторы, которых челик дизлайкнул за последние ttl секунд, без запросов в базу
+    def __init__(self, ttl=24 * 60 * 60):
+        self.ttl = ttl
+        # {профиль: {картинка: (автор, время оценки)}}
+        self.dislikes = {}
+        self.lock = Lock()
+
+    @timeit
+    def load(self):
+        dislikes = {}
+        for profile_id, image_id, uploader_id, score_datetime in ImageScore.objects.filter(
+            score__lt=0,
+            datetime__gte=datetime_now() - datetime.timedelta(seconds=self.ttl),
+        ).values_list("profile", "image", "image__profile", "datetime"):
+            dislikes.setdefault(profile_id, {})[image_id] = (uploader_id, score_datetime.timestamp())
+        with self.lock:
+            self.dislikes = dislikes
+
+    def update(self, profile_id, image_id, uploader_id, score, timestamp=None):
+        with self.lock:
+            if score < 0:
+                self.dislikes.setdefault(profile_id, {})[image_id] = (uploader_id, timestamp or time.time())
+            elif image_id in self.dislikes.get(profile_id, {}):
+                del self.dislikes[profile_id][image_id]
+
+    def get_many(self, profile_ids):
+        expired = time.time() - self.ttl
+        result = {}
+        with self.lock:
+            for profile_id in profile_ids:
+                if not (images := self.dislikes.get(profile_id)):
+                    continue
+                for image_id, (uploader_id, timestamp) in list(images.items()):
+                    if timestamp < expired:
+                        del images[image_id]
+                    else:
+                        result.setdefault(profile_id, set()).add(uploader_id)
+                if not images:
+                    del self.dislikes[profile_id]
+        return result
+
+
+class ColabFilter():
+    def __init__(self, background=True, snapshot_path=None, backend=None):
+        self.model = None
+        self.background = background
+        self.model_class = BACKENDS[backend or settings.COLAB_FILTER_BACKEND]
+        # None - путь из настроек, пустая строка - без слепков
+        self.snapshot_path = settings.COLAB_FILTER_SNAPSHOT if snapshot_path is None else snapshot_path
+        self.rebuild_lock = Lock()
+        self.rebuild_thread = None
+        # проверка is_rebuilding и запуск потока под одним замком
+        self.start_lock = Lock()
+        # пересобирает и публикует модель только один процесс, остальные читают его слепки
+        self.rebuilder_lock_file = None
+        self.rebuilder = self.acquire_rebuilder()
+        # оценки и модерация, пришедшие во время пересборки, досылаются в новую модель
+        self.pending_scores = None
+        self.pending_excluded = None
+        self.pending_reports = None
+        self.recent_dislikes = RecentDislikes()
+        self.recent_dislikes.load()
+        self.update_timer = time.time()
+        self.count_timer = 0
+        self.image_count = Image.objects.count()
+        if self.snapshot_path and (model := self.model_class.load(self.snapshot_path)):
+            # стартуем со слепка и догоняем оценки, пришедшие после него;
+            # если их слишком много, пересборщик отдает слепок как есть и пересобирает модель в фоне
+            if self.rebuilder and model.newer_scores(model.watermark).count() > CATCH_UP_LIMIT:
+                self.model = model
+                self.start_rebuild()
+            else:
+                model.catch_up()
+                self.model = model
+            logging.info(f"ColabFilter loaded from {self.snapshot_path}, model age: {self.model_age():.0f}s")
+        else:
+            self.rebuild()
+
+    def acquire_rebuilder(self):
+        if not self.snapshot_path or fcntl is None:
+            return True
+        Path(self.snapshot_path).mkdir(parents=True, exist_ok=True)
+        lock_file = open(Path(self.snapshot_path) / "rebuild.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.rebuilder_lock_file = lock_file
+        return True
+
+    def start_pending(self):
+        with self.rebuild_lock:
+            self.pending_scores = []
+            self.pending_excluded = []
+            self.pending_reports = []
+
+    def swap_model(self, model):
+        # досылает в новую модель пришедшее во время сборки или загрузки и подменяет ей текущую,
+        # возвращает возраст замененной модели
+        with self.rebuild_lock:
+            previous_age = self.model_age()
+            if model is not None:
+                # отложенное могла уже забрать другая сборка, тогда досылать нечего
+                model.apply_scores(self.pending_scores or [])
+                model.exclude_images(self.pending_excluded or [])
+                model.report_images(self.pending_reports or [])
+                # присваивание атомарно: predict видит либо старую, либо новую модель целиком
+                self.model = model
+            self.pending_scores = None
+            self.pending_excluded = None
+            self.pending_reports = None
+            self.update_timer = time.time()
+        return previous_age
+
+    def rebuild(self):
+        self.start_pending()
+        try:
+            model = self.model_class.build(self.model)
+        except Exception:
+            logging.exception("ColabFilter rebuild failed")
+            model = None
+        if model is not None and self.snapshot_path and self.rebuilder:
+            try:
+                model.save(self.snapshot_path)
+            except OSError:
+                logging.exception("ColabFilter snapshot save failed")
+        previous_age = self.swap_model(model)
+        if model is not None:
+            logging.info(f"ColabFilter rebuilt in {model.build_time:.2f}s, replaced model age: {previous_age}")
+
+    def attach_generation(self):
+        generation = ColabModel.current_generation(self.snapshot_path)
+        if not generation or (self.model and self.model.generation == generation):
+            return
+        self.start_pending()
+        try:
+            if model := self.model_class.load(self.snapshot_path):
+                model.catch_up()
+                # дизлайки, поставленные через другие процессы
+                self.recent_dislikes.load()
+        except Exception:
+            logging.exception("ColabFilter attach failed")
+            model = None
+        previous_age = self.swap_model(model)
+        if model is not None:
+            logging.info(f"ColabFilter attached generation {generation}, replaced model age: {previous_age}")
+
+    def is_rebuilding(self):
+        return self.rebuild_thread is not None and self.rebuild_thread.is_alive()
 
     def check_updates(self):
+        if not self.rebuilder:
+            if time.time() - self.update_timer > GENERATION_CHECK_INTERVAL and not self.is_rebuilding():
+                self.update_timer = time.time()
+                # пересборщик мог завершиться, тогда его роль забирает этот процесс
+                self.rebuilder = self.acquire_rebuilder()
+                # загрузка и догонка поколения идут в фоне, predict пока отвечает старой моделью
+                self.start_attach()
+            return
+        if self.is_rebuilding():
+            return
+        if (model := self.model) is not None and model.overlay_cells > OVERLAY_REBUILD_CELLS:
+            self.start_rebuild()
+            return
+        # число картинок в базе проверяется не чаще раза в минуту и только когда модель устарела
+        if time.time() - self.update_timer < 15 * 60 or time.time() - self.count_timer < 60:
+            return
+        self.count_timer = time.time()
         image_count = Image.objects.count()
-        if image_count - self.image_count > 25 and time.time() - self.update_timer > 15 * 60:
+        if image_count - self.image_count > 25:
             self.image_count = image_count
-            if self.update_data_from_db():
-                self.update_cosine()
-            self.update_timer = time.time()
+            self.start_rebuild()
+
+    def start_rebuild(self):
+        self.start_background(self.rebuild, "colab-filter-rebuild")
+
+    def start_attach(self):
+        self.start_background(self.attach_generation, "colab-filter-attach")
+
+    def start_background(self, target, name):
+        # пересборка и загрузка поколения не идут одновременно: из параллельных predict запускает
+        # только тот, кто взял start_lock, остальные ничего не ждут и отвечают текущей моделью
+        if not self.start_lock.acquire(blocking=False):
+            return
+        try:
+            if self.is_rebuilding():
+                return
+            if not self.background:
+                target()
+                return
+            self.rebuild_thread = Thread(target=target, name=name, daemon=True)
+            self.rebuild_thread.start()
+        finally:
+            self.start_lock.release()
+
+    def model_age(self):
+        if self.model is None:
+            return None
+        return time.time() - self.model.built_at
+
+    def stat(self):
+        model = self.model
+        return {
+            "model_age": self.model_age(),
+            "build_time": model.build_time if model else None,
+            "rebuilding": self.is_rebuilding(),
+            "rebuilder": self.rebuilder,
+            "backend": self.model_class.backend,
+            "generation": model.generation if model else None,
+            "users": len(model.user_ids) if model else 0,
+            "images": len(model.image_ids) if model else 0,
+        }
+
+    @timeit
+    def update_score(self, image_score):
+        score = (image_score.profile.id, image_score.image.id, image_score.score)
+        self.recent_dislikes.update(*score[:2], image_score.image.profile_id, image_score.score)
+        with self.rebuild_lock:
+            if self.pending_scores is not None:
+                self.pending_scores.append(score)
+        if model := self.model:
+            return model.update_score(*score)
+
+    def exclude_images(self, image_ids):
+        with self.rebuild_lock:
+            if self.pending_excluded is not None:
+                self.pending_excluded.extend(image_ids)
+        if model := self.model:
+            model.exclude_images(image_ids)
+
+    def report_images(self, image_ids):
+        with self.rebuild_lock:
+            if self.pending_reports is not None:
+                self.pending_reports.extend(image_ids)
+        if model := self.model:
+            model.report_images(image_ids)
+
+    def get_similar_profiles(self, target_profile_id):
+        if (model := self.model) is None:
+            return list(
+                ProfileSimilarity.objects
+                    .filter(profile_id=target_profile_id, taste_sim__gt=0)
+                    .values_list("neighbour_id", flat=True)
+            )
+        return model.get_similar_profiles(
+            target_profile_id, self.recent_dislikes.get_many([target_profile_id])
+        )
 
     @timeit
     def predict(self, target_profile_id, count=50):
         self.check_updates()
-        if target_profile_id not in self.user_ids:
-            return [{
-                "taste_similarity": 0,
-                "image_id": random.choice(self.image_ids)
-            }]
-
-        profile_index = self.user_ids.index(target_profile_id)
-        last_dislikes = ImageScore.last_dislikes(target_profile_id)
-        users = np.setdiff1d(
-            np.where(self.cosine[profile_index] > 0),
-            np.array([self.user_ids.index(profile_id) for profile_id in last_dislikes])
-        )
-        items = np.where(self.raw_data[profile_index] == 0)
-        if len(items[0]) == 0:
-            return []
-        user_cosine_data = self.cosine[profile_index, users]
-
-        prediction_data = self.raw_data[users, :][:, items[0]]
-        prediction = np.dot(prediction_data.T, user_cosine_data) / np.sqrt(np.count_nonzero(prediction_data, axis=0) + 1)
-        top_items_pos = prediction.argsort()[-count:]
-        predict_image = [
-            {
-                "taste_similarity": prediction[item_pos],
-                "image_id": self.image_ids[items[0][item_pos]],
-            } for item_pos in reversed(top_items_pos)
-        ]
-        return predict_image
-
-    def test_colab_filter(self):
-        for profile_index, target_profile_id in enumerate(self.user_ids):
-            users = np.where(self.cosine[profile_index] > 0)
-            items = np.where(self.raw_data[profile_index] != 0)
-            if len(items[0]) == 0:
-                continue
-            user_cosine_data = self.cosine[profile_index, users][0]
-            prediction_data = self.raw_data[users, :][0, :, :][:, items][:, 0, :]
-            raw_prediction = np.dot(prediction_data.T, user_cosine_data)
-            scores_count = np.count_nonzero(prediction_data, axis=0) + 1
-            prediction = raw_prediction / scores_count
-
-            prediction[prediction >= 0] = 1
-            prediction[prediction < 0] = -1
-            rd = self.raw_data[0, items]
-            rd[rd >= 0] = 1
-            rd[rd < 0] = -1
-            diff = rd - prediction
-            print('correct:', len(diff[diff == 0]), '| false positive:', len(diff[diff == -2]), "| false negative: ", len(diff[diff == 2]), "| result: ", len(diff[diff == 0]) / len(diff[0]))
+        if (model := self.model) is None:
+            # модели нет - рекомендации только на базе
+            return Image.colab_filter_images(target_profile_id, count)
+        return model.predict(target_profile_id, count, self.recent_dislikes.get_many([target_profile_id]))
+
+    @timeit
+    def predict_many(self, profile_ids, count=50):
+        self.check_updates()
+        if (model := self.model) is None:
+            return {profile_id: Image.colab_filter_images(profile_id, count) for profile_id in profile_ids}
+        return model.predict_many(profile_ids, count, self.recent_dislikes.get_many(profile_ids))
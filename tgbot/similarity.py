@@ -0,0 +1,66 @@
+# построение индекса соседей без django: модуль импортируют процессы пула
+import numpy as np
+
+# данные, переданные процессу пула при запуске
+WORKER_DATA = {}
+
+
+def top_neighbours(similarity, offset, k):
+    rows = np.arange(similarity.shape[0])
+    # сам с собой челик не сосед
+    similarity[rows, rows + offset] = 0
+    if similarity.shape[1] <= k:
+        similarity = np.pad(similarity, ((0, 0), (0, k + 1 - similarity.shape[1])))
+    top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+    top_sims = np.take_along_axis(similarity, top, axis=1)
+    order = np.argsort(-top_sims, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_sims = np.take_along_axis(top_sims, order, axis=1)
+    # в predict используются только похожие вкусы
+    top[top_sims <= 0] = -1
+    top_sims[top_sims <= 0] = 0
+    return top, top_sims
+
+
+def merge_neighbours(neighbours, neighbour_sims, candidates, candidate_sims, block):
+    # слить строки индекса соседей с кандидатами той же ширины, повторы считаются один раз
+    k = neighbours.shape[1]
+    for start in range(0, len(neighbours), block):
+        stop = min(start + block, len(neighbours))
+        cols = np.concatenate([neighbours[start:stop], candidates[start:stop]], axis=1)
+        sims = np.concatenate([neighbour_sims[start:stop], candidate_sims[start:stop]], axis=1)
+        order = np.argsort(cols, axis=1, kind="stable")
+        cols = np.take_along_axis(cols, order, axis=1)
+        sims = np.take_along_axis(sims, order, axis=1)
+        sims[:, 1:][cols[:, 1:] == cols[:, :-1]] = 0
+        sims[cols < 0] = 0
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        top = np.take_along_axis(cols, np.take_along_axis(top, order, axis=1), axis=1)
+        top_sims = np.take_along_axis(top_sims, order, axis=1)
+        top[top_sims <= 0] = -1
+        top_sims[top_sims <= 0] = 0
+        neighbours[start:stop], neighbour_sims[start:stop] = top, top_sims
+
+
+def neighbour_rows(normed, normed_t, start, stop, k, block):
+    # top-k соседей для строк start:stop, схожесть считается блоками по block строк
+    neighbours = np.full((stop - start, k), -1, dtype=np.int32)
+    neighbour_sims = np.zeros((stop - start, k), dtype=np.float32)
+    for block_start in range(start, stop, block):
+        block_stop = min(block_start + block, stop)
+        rows = slice(block_start - start, block_stop - start)
+        neighbours[rows], neighbour_sims[rows] = top_neighbours(
+            (normed[block_start:block_stop] @ normed_t).toarray(), block_start, k
+        )
+    return neighbours, neighbour_sims
+
+
+def init_worker(normed):
+    WORKER_DATA["normed"] = normed
+    WORKER_DATA["normed_t"] = normed.T.tocsc()
+
+
+def worker_neighbour_rows(start, stop, k, block):
+    return neighbour_rows(WORKER_DATA["normed"], WORKER_DATA["normed_t"], start, stop, k, block)
@@ -1,12 +1,28 @@
-from contextlib import suppress
+import datetime
+import io
+import json
+import tempfile
+import time
+from contextlib import contextmanager, suppress
+from threading import Event, Thread
+from types import SimpleNamespace
+from unittest import mock
 
-from django.test import TestCase
+import numpy as np
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.db import connection
 from django.db.utils import IntegrityError
+from django.test.utils import CaptureQueriesContext
 
-from tgbot.models import ImageScore, ImageBlock, Image, Profile
-from tgbot.recommendations import ColabFilter
+from tgbot.models import ImageScore, ImageBlock, Image, Profile, ProfileSimilarity, Report, UploadTask, datetime_now
+from tgbot import recommendations
+from tgbot.duplicates import BloomFilter, HashPool, PhashIndex, hamming, phash_to_int
+from tgbot.recommendations import ColabFilter, ColabModel, FactorModel, ItemModel
 
 
+@override_settings(COLAB_FILTER_SNAPSHOT="")
 class RecommendationTestCase(TestCase):
     def setUp(self):
         for i in range(5):
@@ -21,6 +37,45 @@ class RecommendationTestCase(TestCase):
         # 3  0,  0,  0,  0,  0,  0,  0,  0,  0,  2,  2,  2,  0,  0,  0
         # 4  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  2,  2,  2
 
+    def create_scores(self):
+        # оценки всех челиков почти по всем картинкам: каждая третья клетка пустая, лайков больше
+        for i in range(15):
+            for tg_id in range(5):
+                if (i + tg_id) % 3:
+                    ImageScore.objects.get_or_create(
+                        profile=Profile.objects.get(tg_id=tg_id),
+                        image=Image.objects.get(file_unique_id=i),
+                        defaults={"score": 1 if (i * tg_id) % 4 else -1},
+                    )
+
+    def score_all_images(self):
+        # челик 1 оценил все картинки: первые 8 лайком, остальные дизлайком
+        for i in range(15):
+            ImageScore.objects.get_or_create(
+                profile=Profile.objects.get(tg_id=1),
+                image=Image.objects.get(file_unique_id=i),
+                defaults={"score": 1 if i < 8 else -1},
+            )
+
+    @contextmanager
+    def fake_downloads(self, hashes):
+        # telegram и пул хэширования подменены: file-x скачивается как байты своего file_id,
+        # хэш и число пикселей берутся из hashes; индексы повторов строятся заново по тестовой базе,
+        # событие воркеров загрузок - свое на каждый тест
+        from tgbot import tg_logic
+        with mock.patch.object(tg_logic, "UPLOAD_WAKEUP", Event()), \
+                mock.patch.object(tg_logic, "PHASH_INDEX", None), \
+                mock.patch.object(tg_logic, "KNOWN_FILES", None), \
+                mock.patch.object(tg_logic, "COLAB_FILTER"), \
+                mock.patch.object(tg_logic.bot, "get_file", side_effect=lambda file_id: SimpleNamespace(
+                    file_path=file_id, file_unique_id=file_id.replace("file", "unique"))), \
+                mock.patch.object(tg_logic.bot, "download_file", side_effect=str.encode), \
+                mock.patch.object(tg_logic.bot, "send_message"), \
+                mock.patch.object(tg_logic.bot, "reply_to"), \
+                mock.patch.object(tg_logic.HASH_POOL, "download_phash",
+                                  side_effect=lambda download, timeout: hashes[download().decode()]):
+            yield tg_logic
+
     def test_dislike(self):
         for i in range(15):
             score = 1 if i < 10 else -1
@@ -57,4 +112,712 @@ class RecommendationTestCase(TestCase):
         cf = ColabFilter()
         prediction = cf.predict(Profile.objects.get(tg_id=1).id)
         a = 1
-        # self.assert
\ No newline at end of file
+        # self.assert
+
+    def test_sparse_matrix(self):
+        self.score_all_images()
+        model = ColabFilter().model
+        # хранятся только поставленные оценки
+        self.assertEqual(model.raw_data.nnz, ImageScore.objects.count())
+        self.assertEqual(model.raw_data.shape, (5, 15))
+        profile_index = model.user_index[Profile.objects.get(tg_id=1).id]
+        self.assertAlmostEqual(float(model.data[profile_index].sum()), 0, places=4)
+
+        # оценки читаются порциями в компактные массивы
+        with mock.patch.object(recommendations, "LOAD_CHUNK", 4):
+            profile_ids, image_ids, scores = recommendations.read_scores(ImageScore.objects.order_by("id"))
+        self.assertEqual(scores.dtype, np.int8)
+        self.assertEqual(
+            list(zip(profile_ids.tolist(), image_ids.tolist(), scores.tolist())),
+            list(ImageScore.objects.order_by("id").values_list("profile_id", "image_id", "score")),
+        )
+        self.assertEqual(model.raw_data.indices.dtype, np.int32)
+
+        cf = ColabFilter()
+
+        profile_id = Profile.objects.get(tg_id=0).id
+        scored = set(ImageScore.objects.filter(profile=profile_id).values_list("image_id", flat=True))
+        prediction = cf.predict(profile_id)
+        self.assertTrue(prediction)
+        self.assertFalse(scored & {p["image_id"] for p in prediction})
+
+    def test_rebuild_swap(self):
+        cf = ColabFilter(background=False)
+        old_model = cf.model
+        profile = Profile.objects.get(tg_id=3)
+        image = Image.objects.get(file_unique_id=0)
+        # оценка, пришедшая во время пересборки, не должна потеряться
+        cf.pending_scores = []
+        cf.update_score(ImageScore.objects.create(profile=profile, image=image, score=1))
+        self.assertEqual(len(cf.pending_scores), 1)
+
+        cf.rebuild()
+        self.assertIsNot(cf.model, old_model)
+        self.assertIsNone(cf.pending_scores)
+        model = cf.model
+        self.assertEqual(
+            model.raw_data[model.user_index[profile.id], model.image_index[image.id]], 1
+        )
+        self.assertGreaterEqual(cf.stat()["model_age"], 0)
+
+        # пока запуск занят другим потоком, второй не стартует; запущенный поток не дает стартовать следующему
+        cf.background = True
+        with mock.patch.object(recommendations, "Thread") as thread:
+            with cf.start_lock:
+                cf.start_rebuild()
+            thread.assert_not_called()
+            cf.start_rebuild()
+            cf.start_attach()
+        self.assertEqual(thread.call_count, 1)
+
+        # две сборки вперемешку: вторая досылает пустое, а не падает на уже забранных отложенных оценках
+        cf.start_pending()
+        first, second = ColabModel.build(cf.model), ColabModel.build(cf.model)
+        cf.swap_model(first)
+        cf.swap_model(second)
+        self.assertIs(cf.model, second)
+
+    def test_neighbour_index(self):
+        self.create_scores()
+        # блоки по две строки, по два соседа на профиль
+        with mock.patch.object(recommendations, "BLOCK_ELEMENTS", 10), \
+                mock.patch.object(recommendations, "NEIGHBOURS_COUNT", 2):
+            model = ColabFilter().model
+
+        data = model.data.toarray()
+        norm = np.linalg.norm(data, axis=1)
+        cosine = data @ data.T / np.outer(norm, norm)
+        np.fill_diagonal(cosine, 0)
+        for profile_index, neighbours in enumerate(model.neighbours):
+            expected = sorted(cosine[profile_index][cosine[profile_index] > 0], reverse=True)[:2]
+            sims = model.neighbour_sims[profile_index][neighbours >= 0]
+            np.testing.assert_allclose(sims, expected, rtol=1e-4)
+            np.testing.assert_allclose(cosine[profile_index, neighbours[neighbours >= 0]], sims, rtol=1e-4)
+
+    @override_settings(COLAB_FILTER_WORKERS=2)
+    def test_parallel_neighbours(self):
+        self.create_scores()
+        model = ColabModel()
+        model.update_data_from_db()
+        model.update_cosine()
+        exact = model.neighbours.copy(), model.neighbour_sims.copy()
+
+        # части строк в пуле процессов дают тот же индекс, что и расчет в одном процессе
+        with mock.patch.object(recommendations, "PARALLEL_MIN_ROWS", 0), \
+                mock.patch.object(recommendations, "BLOCK_ELEMENTS", 10):
+            model.update_cosine()
+        np.testing.assert_array_equal(model.neighbours, exact[0])
+        np.testing.assert_allclose(model.neighbour_sims, exact[1], rtol=1e-5)
+
+    def test_lsh_neighbours(self):
+        self.create_scores()
+        model = ColabModel()
+        model.update_data_from_db()
+        model.update_cosine()
+        exact = model.neighbours.copy(), model.neighbour_sims.copy()
+
+        # одна корзина на всех: те же соседи, что и при переборе всех пар
+        model.update_cosine(lsh_tables=1, lsh_bits=0)
+        np.testing.assert_array_equal(model.neighbours, exact[0])
+        np.testing.assert_allclose(model.neighbour_sims, exact[1], rtol=1e-5)
+
+        # с мелкими корзинами соседи - подмножество точных с той же схожестью
+        model.update_cosine(lsh_tables=2, lsh_bits=8)
+        for row in range(len(model.user_ids)):
+            for neighbour, sim in zip(model.neighbours[row], model.neighbour_sims[row]):
+                if neighbour >= 0:
+                    self.assertIn(neighbour, exact[0][row])
+                    self.assertAlmostEqual(sim, exact[1][row][list(exact[0][row]).index(neighbour)], places=5)
+
+    def test_predict_many(self):
+        self.create_scores()
+        model = ColabFilter().model
+        profile_ids = list(Profile.objects.values_list("id", flat=True))
+        predictions = model.predict_many(profile_ids, count=3)
+
+        raw_data = model.raw_data.toarray()
+        last_dislikes = ImageScore.last_dislikes_many(profile_ids)
+        for profile_id in profile_ids:
+            profile_index = model.user_index[profile_id]
+            # то же самое, что делал predict по одному челику
+            users = [
+                user for user in model.neighbours[profile_index]
+                if user >= 0 and model.user_ids[user] not in last_dislikes.get(profile_id, ())
+            ]
+            sims = model.neighbour_sims[profile_index][np.isin(model.neighbours[profile_index], users)]
+            items = np.where(raw_data[profile_index] == 0)[0]
+            prediction_data = raw_data[users][:, items]
+            prediction = prediction_data.T @ sims / np.sqrt(np.count_nonzero(prediction_data, axis=0) + 1)
+            np.testing.assert_allclose(
+                [p["taste_similarity"] for p in predictions[profile_id]],
+                sorted(prediction, reverse=True)[:3],
+                rtol=1e-4,
+            )
+            self.assertFalse(set(model.image_ids[item] for item in np.where(raw_data[profile_index])[0])
+                             & {p["image_id"] for p in predictions[profile_id]})
+
+    def test_snapshot(self):
+        self.score_all_images()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = f"{tmp_dir}/colab_filter"
+            model = ColabFilter(background=False, snapshot_path=snapshot_path).model
+
+            # оценка после слепка догоняется при загрузке
+            ImageScore.objects.filter(
+                profile=Profile.objects.get(tg_id=0), image=Image.objects.get(file_unique_id=0)
+            ).update(score=-2, datetime=datetime_now())
+            loaded = ColabFilter(background=False, snapshot_path=snapshot_path).model
+
+            np.testing.assert_array_equal(loaded.user_ids, model.user_ids)
+            self.assertEqual(loaded.built_at, model.built_at)
+            np.testing.assert_array_equal(loaded.neighbours, model.neighbours)
+            # массивы открыты с диска, а не скопированы
+            self.assertIsInstance(loaded.neighbours.base, np.memmap)
+            self.assertFalse(loaded.data.data.flags.owndata)
+            indices, values = loaded.user_row(loaded.user_index[Profile.objects.get(tg_id=0).id])
+            self.assertEqual(values[indices == loaded.image_index[Image.objects.get(file_unique_id=0).id]], -2)
+
+            # длинный хвост не догоняется: слепок отдается как есть, модель пересобирается
+            with mock.patch.object(recommendations, "CATCH_UP_LIMIT", 0), \
+                    mock.patch.object(ColabModel, "catch_up") as catch_up:
+                rebuilt = ColabFilter(background=False, snapshot_path=snapshot_path).model
+            catch_up.assert_not_called()
+            self.assertNotEqual(rebuilt.generation, loaded.generation)
+            indices, values = rebuilt.user_row(rebuilt.user_index[Profile.objects.get(tg_id=0).id])
+            self.assertEqual(values[indices == rebuilt.image_index[Image.objects.get(file_unique_id=0).id]], -2)
+
+    def test_shared_generations(self):
+        self.score_all_images()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rebuilder = ColabFilter(background=False, snapshot_path=tmp_dir)
+            worker = ColabFilter(background=False, snapshot_path=tmp_dir)
+            self.assertTrue(rebuilder.rebuilder)
+            self.assertFalse(worker.rebuilder)
+            self.assertEqual(worker.model.generation, rebuilder.model.generation)
+
+            time.sleep(0.01)
+            rebuilder.rebuild()
+            self.assertNotEqual(worker.model.generation, rebuilder.model.generation)
+            worker.update_timer = 0
+            worker.check_updates()
+            self.assertEqual(worker.model.generation, rebuilder.model.generation)
+
+            # новое поколение загружается в фоне, скрытое во время загрузки досылается в него
+            time.sleep(0.01)
+            rebuilder.rebuild()
+            worker.background, worker.update_timer = True, 0
+            image_id = Image.objects.get(file_unique_id=0).id
+            with mock.patch.object(recommendations, "Thread") as thread:
+                worker.check_updates()
+            self.assertNotEqual(worker.model.generation, rebuilder.model.generation)
+            load = ColabModel.load
+
+            def load_excluding(root):
+                worker.exclude_images([image_id])
+                return load(root)
+
+            with mock.patch.object(ColabModel, "load", side_effect=load_excluding):
+                thread.call_args.kwargs["target"]()
+            self.assertEqual(worker.model.generation, rebuilder.model.generation)
+            self.assertTrue(worker.model.excluded[worker.model.image_index[image_id]])
+            self.assertIsNone(worker.pending_excluded)
+            rebuilder.rebuilder_lock_file.close()
+
+    def test_incremental_update(self):
+        self.create_scores()
+        cf = ColabFilter(background=False)
+        self.assertEqual(len(cf.model.user_ids), 5)
+
+        # новый челик и новая картинка попадают в модель без пересборки
+        new_image = Image.new_image(0, 15, 15, 15)
+        cf.update_score(ImageScore.objects.get(image=new_image))
+        profile = Profile.update_profile(5, "5", "ru")
+        for i in range(0, 15, 2):
+            cf.update_score(ImageScore.objects.create(
+                profile=profile, image=Image.objects.get(file_unique_id=i), score=1 if i % 4 else -1
+            ))
+        model = cf.model
+        self.assertEqual(len(model.user_ids), 6)
+        self.assertIn(new_image.id, model.image_ids)
+        self.assertTrue(cf.predict(profile.id))
+
+        # строка соседей совпадает с полной пересборкой
+        rebuilt = ColabFilter(background=False).model
+        row, rebuilt_row = model.user_index[profile.id], rebuilt.user_index[profile.id]
+        self.assertTrue((model.neighbours[row] >= 0).any())
+        np.testing.assert_allclose(model.neighbour_sims[row], rebuilt.neighbour_sims[rebuilt_row], rtol=1e-4)
+        np.testing.assert_array_equal(
+            model.user_ids[model.neighbours[row][model.neighbours[row] >= 0]],
+            rebuilt.user_ids[rebuilt.neighbours[rebuilt_row][rebuilt.neighbours[rebuilt_row] >= 0]],
+        )
+
+        # разросшийся overlay сливается в новую сборку при следующем predict
+        with mock.patch.object(recommendations, "OVERLAY_REBUILD_CELLS", model.overlay_cells - 1):
+            cf.predict(profile.id)
+        self.assertIsNot(cf.model, model)
+        self.assertEqual(cf.model.overlay_cells, 0)
+        self.assertIn(profile.id, cf.model.user_ids)
+
+    def test_delta_rebuild(self):
+        self.create_scores()
+        previous = ColabFilter(background=False).model
+
+        # новая оценка, измененная оценка, блокировка и удаление картинки
+        ImageScore.objects.filter(profile__tg_id=0, image__file_unique_id=0).delete()
+        ImageScore.objects.create(
+            profile=Profile.objects.get(tg_id=0), image=Image.objects.get(file_unique_id=0), score=-2
+        )
+        ImageScore.set_score(1, 4, 2)
+        ImageBlock.block_image(1, 5)
+        Image.delete_image(2, 6)
+
+        # без полной перезагрузки
+        with self.assertNoLogs(level="INFO"):
+            model = ColabModel.build(previous)
+        full = ColabModel.build()
+        np.testing.assert_array_equal(model.user_ids, full.user_ids)
+        np.testing.assert_array_equal(model.image_ids, full.image_ids)
+        self.assertEqual((model.raw_data != full.raw_data).nnz, 0)
+
+    def test_recent_dislikes(self):
+        self.create_scores()
+        cf = ColabFilter(background=False)
+        profile_ids = list(Profile.objects.values_list("id", flat=True))
+        self.assertEqual(cf.recent_dislikes.get_many(profile_ids), ImageScore.last_dislikes_many(profile_ids))
+
+        # дизлайк попадает в трекер сразу, predict не ходит в базу
+        cf.update_score(ImageScore.set_score(0, 3, -1))
+        self.assertEqual(cf.recent_dislikes.get_many(profile_ids), ImageScore.last_dislikes_many(profile_ids))
+        with self.assertNumQueries(0):
+            cf.predict(profile_ids[0])
+            cf.predict_many(profile_ids)
+
+        cf.update_score(ImageScore.set_score(0, 3, 1))
+        self.assertEqual(cf.recent_dislikes.get_many(profile_ids), ImageScore.last_dislikes_many(profile_ids))
+        cf.recent_dislikes.ttl = 0
+        self.assertEqual(cf.recent_dislikes.get_many(profile_ids), {})
+
+    def test_factor_backend(self):
+        self.create_scores()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = f"{tmp_dir}/colab_filter"
+            cf = ColabFilter(background=False, snapshot_path=snapshot_path, backend="svd")
+            model = cf.model
+            self.assertIsInstance(model, FactorModel)
+            profile_id = Profile.objects.get(tg_id=1).id
+            row = model.user_index[profile_id]
+            predictions = cf.predict(profile_id, count=15)
+            # предсказание - произведение векторов челика и картинки, оцененные картинки не предлагаются
+            scored = set(ImageScore.objects.filter(profile_id=profile_id).values_list("image_id", flat=True))
+            self.assertEqual({p["image_id"] for p in predictions}, set(model.image_ids.tolist()) - scored)
+            for prediction in predictions:
+                self.assertAlmostEqual(
+                    prediction["taste_similarity"],
+                    model.user_factors[row] @ model.item_factors[model.image_index[prediction["image_id"]]],
+                    places=5,
+                )
+            self.assertLessEqual(len(cf.get_similar_profiles(profile_id)), len(model.user_ids) - 1)
+
+            # новая оценка сдвигает вектор челика без пересборки
+            factors = model.user_factors[row].copy()
+            cf.update_score(ImageScore.set_score(1, Image.objects.get(id=predictions[0]["image_id"]).file_unique_id, -2))
+            self.assertFalse(np.allclose(model.user_factors[row], factors))
+            self.assertNotIn(predictions[0]["image_id"], {p["image_id"] for p in cf.predict(profile_id, count=15)})
+
+            # слепок другого движка не подхватывается
+            self.assertIsInstance(ColabFilter(background=False, snapshot_path=snapshot_path, backend="svd").model, FactorModel)
+            self.assertIsNone(ColabModel.load(snapshot_path))
+
+    def test_item_backend(self):
+        self.create_scores()
+        cf = ColabFilter(background=False, backend="item")
+        model = cf.model
+        self.assertIsInstance(model, ItemModel)
+        # соседи картинки совпадают с косинусом центрированных столбцов
+        data = model.data.toarray()
+        norms = np.linalg.norm(data, axis=0)
+        sims = (data.T @ data) / np.outer(norms, norms)
+        for col, (neighbours, neighbour_sims) in enumerate(zip(model.item_neighbours, model.item_neighbour_sims)):
+            valid = neighbours >= 0
+            np.testing.assert_allclose(neighbour_sims[valid], sims[col, neighbours[valid]], rtol=1e-4)
+            self.assertNotIn(col, neighbours)
+
+        profile_id = Profile.objects.get(tg_id=2).id
+        row = model.user_index[profile_id]
+        liked = np.where(model.raw_data.toarray()[row] > 0)[0]
+        expected = {}
+        for col in liked:
+            for neighbour, sim in zip(model.item_neighbours[col], model.item_neighbour_sims[col]):
+                if neighbour >= 0 and not model.raw_data[row, neighbour]:
+                    expected[neighbour] = expected.get(neighbour, 0) + sim * model.raw_data[row, col]
+        predictions = cf.predict(profile_id)
+        self.assertEqual(
+            {p["image_id"]: round(float(p["taste_similarity"]), 4) for p in predictions},
+            {int(model.image_ids[col]): round(float(score), 4) for col, score in expected.items()},
+        )
+        self.assertLessEqual(len(cf.get_similar_profiles(profile_id)), len(model.user_ids) - 1)
+
+        # свежий лайк сразу добавляет соседей своей картинки
+        image_id = next(p["image_id"] for p in predictions)
+        cf.update_score(ImageScore.set_score(2, Image.objects.get(id=image_id).file_unique_id, 2))
+        self.assertNotIn(image_id, {p["image_id"] for p in cf.predict(profile_id)})
+
+    def test_popular(self):
+        ImageScore.set_score(1, 0, 1)
+        ImageScore.set_score(2, 0, 1)
+        ImageScore.objects.filter(profile__tg_id=2).update(datetime=datetime_now() - datetime.timedelta(days=30))
+        ImageScore.set_score(3, 5, 1)
+        ImageScore.set_score(4, 7, 2)
+        Report.new_report(0, 7)
+        cf = ColabFilter(background=False)
+        image_ids = dict(Image.objects.values_list("file_unique_id", "id"))
+
+        # свежие лайки выше старых, жалобы опускают картинку ниже неоцененных, среди равных - новые
+        Profile.update_profile(5, "5", "ru")
+        predictions = cf.predict(Profile.objects.get(tg_id=5).id, count=4)
+        self.assertEqual([p["image_id"] for p in predictions], [image_ids[i] for i in ["0", "5", "14", "13"]])
+        self.assertEqual(predictions[-1]["taste_similarity"], 0)
+        self.assertEqual(cf.model.image_ids[cf.model.popular[-1]], image_ids["7"])
+
+        # у челика 0 похожих нет: выдается популярное без уже оцененного, а не картинки с нулевой оценкой
+        predictions = cf.predict(Profile.objects.get(tg_id=0).id, count=3)
+        self.assertEqual([p["image_id"] for p in predictions], [image_ids[i] for i in ["5", "14", "13"]])
+        # похожий на челика 1 предлагает три картинки, остаток страницы - популярное
+        predictions = cf.predict(Profile.objects.get(tg_id=1).id, count=5)
+        self.assertEqual({p["image_id"] for p in predictions[:3]}, {image_ids[i] for i in ["6", "7", "8"]})
+        self.assertTrue(all(p["taste_similarity"] > 0 for p in predictions[:3]))
+        self.assertEqual([p["image_id"] for p in predictions[3:]], [image_ids[i] for i in ["14", "13"]])
+
+    def test_moderation_mask(self):
+        for i in range(15):
+            for tg_id in range(5):
+                if (i + tg_id) % 3 == 0 and i // 3 != tg_id:
+                    ImageScore.set_score(tg_id, i, 1)
+        cf = ColabFilter(background=False)
+        profile_id = Profile.objects.get(tg_id=4).id
+        image_ids = [p["image_id"] for p in cf.predict(profile_id, count=15)]
+        self.assertGreaterEqual(len(image_ids), 3)
+
+        # блокировка и удаление скрывают картинку сразу, без запросов в базу и пересборки
+        with self.assertNumQueries(0):
+            cf.exclude_images(image_ids[:1])
+            self.assertNotIn(image_ids[0], [p["image_id"] for p in cf.predict(profile_id, count=15)])
+
+        # жалобы копятся до REPORT_LIMIT
+        for tg_id in range(recommendations.REPORT_LIMIT):
+            self.assertIn(image_ids[1], [p["image_id"] for p in cf.predict(profile_id, count=15)])
+            report = Report.new_report(tg_id, Image.objects.get(id=image_ids[1]).file_unique_id)
+            cf.report_images([report.image_id])
+        self.assertNotIn(image_ids[1], [p["image_id"] for p in cf.predict(profile_id, count=15)])
+        self.assertNotIn(image_ids[1], [p["image_id"] for p in cf.model.popular_images(15)])
+
+        # после пересборки жалобы берутся из базы
+        cf.rebuild()
+        self.assertTrue(cf.model.excluded[cf.model.image_index[image_ids[1]]])
+        self.assertFalse(cf.model.excluded[cf.model.image_index[image_ids[0]]])
+
+        # модерация после слепка подтягивается при загрузке: блокировки, удаления, жалобы и разблокировки
+        def block(image_id):
+            image = Image.objects.get(id=image_id)
+            ImageBlock.block_image(image.profile.tg_id, image.file_unique_id)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            block(image_ids[0])
+            ColabFilter(background=False, snapshot_path=tmp_dir)
+            ImageBlock.objects.filter(image_id=image_ids[0]).delete()
+            block(image_ids[2])
+            Image.objects.filter(id=image_ids[3]).delete()
+            for tg_id in range(recommendations.REPORT_LIMIT):
+                Report.new_report(tg_id, Image.objects.get(id=image_ids[4]).file_unique_id)
+            model = ColabFilter(background=False, snapshot_path=tmp_dir).model
+        predicted = [p["image_id"] for p in model.predict(profile_id, count=15, last_dislikes={})]
+        self.assertIn(image_ids[0], model.image_index)
+        for image_id in image_ids[2:5]:
+            self.assertNotIn(image_id, predicted)
+            self.assertNotIn(image_id, [p["image_id"] for p in model.popular_images(15)])
+
+    def test_profile_similarity(self):
+        self.create_scores()
+        call_command("similarity", stdout=io.StringIO())
+        scores = {}
+        for profile_id, image_id, score in ImageScore.objects.values_list("profile_id", "image_id", "score"):
+            scores.setdefault(profile_id, {})[image_id] = score
+        for profile_id, mine in scores.items():
+            expected = {}
+            for other_id, theirs in scores.items():
+                common = set(mine) & set(theirs)
+                if other_id != profile_id and common:
+                    agreement = sum(theirs[i] * (1 if mine[i] >= 1 else -1) for i in common)
+                    expected[other_id] = (round(agreement / (len(common) + 1), 6), len(common))
+            self.assertEqual(
+                {
+                    row.neighbour_id: (round(row.taste_sim, 6), row.scores_count)
+                    for row in ProfileSimilarity.objects.filter(profile_id=profile_id)
+                },
+                expected,
+            )
+        self.assertEqual(
+            {row["tg_id"] for row in Profile.get_similar_profiles(0)},
+            set(ProfileSimilarity.objects.filter(profile__tg_id=0).values_list("neighbour__tg_id", flat=True)),
+        )
+
+        # пересчитываются только профили с новыми оценками
+        from tgbot.management.commands.similarity import job
+        self.assertEqual(job(), 0)
+        ImageScore.set_score(1, 0, -2)
+        self.assertEqual(job(), 1)
+
+        # без модели рекомендации идут из базы: непросмотренные картинки, не больше count
+        cf = ColabFilter(background=False)
+        cf.model = None
+        profile_id = Profile.objects.get(tg_id=1).id
+        with CaptureQueriesContext(connection) as queries:
+            predictions = cf.predict(profile_id, count=4)
+        self.assertLessEqual(len(queries), 5)
+        self.assertEqual(len(predictions), 4)
+        self.assertFalse(set(scores[profile_id]) & {p["image_id"] for p in predictions})
+        self.assertEqual(
+            [p["taste_similarity"] for p in predictions],
+            sorted([p["taste_similarity"] for p in predictions], reverse=True),
+        )
+        self.assertTrue(cf.get_similar_profiles(profile_id))
+
+    def test_phash_index(self):
+        self.assertEqual(phash_to_int("ffffffffffffffff"), -1)
+        self.assertEqual(hamming(phash_to_int("ffffffffffffffff"), 0), 64)
+        self.assertEqual(Image.objects.get(file_unique_id=10).phash_int, 16)
+
+        rng = np.random.default_rng(0)
+        hashes = [phash_to_int(f"{value:016x}") for value in rng.integers(0, 2 ** 63, size=500) * 2 + 1]
+        # почти повторы: пара бит отличается
+        hashes += [phash ^ 0b101 for phash in hashes[:50]]
+        index = PhashIndex(enumerate(hashes))
+        self.assertEqual(len(index), len(hashes))
+        for phash in hashes[::10] + [0]:
+            self.assertEqual(
+                index.search(phash, 8),
+                sorted((hamming(phash, other), image_id) for image_id, other in enumerate(hashes)
+                       if hamming(phash, other) <= 8),
+            )
+        self.assertIn(index.nearest(hashes[3] ^ 1, 2), (3, 503))
+        index.remove(3)
+        index.remove(503)
+        self.assertIsNone(index.nearest(hashes[3], 2))
+        index.add(hashes[3], 1000)
+        self.assertEqual(index.nearest(hashes[3], 0), 1000)
+
+    def test_hash_pool(self):
+        import imagehash
+        from PIL import Image as PILImage
+
+        images = []
+        for seed in range(3):
+            pixels = np.random.default_rng(seed).integers(0, 255, size=(60, 80, 3), dtype=np.uint8)
+            file = io.BytesIO()
+            PILImage.fromarray(pixels).save(file, format="PNG")
+            images.append((file.getvalue(), str(imagehash.phash(PILImage.fromarray(pixels)))))
+        pool = HashPool(workers=1, queue_size=1)
+        try:
+            # не дождались хэша: пул сбрасывается, следующая картинка поднимает новый
+            with self.assertRaises(TimeoutError):
+                pool.phash(images[0][0], timeout=0.000001)
+            self.assertIsNone(pool.executor)
+            for file_bytes, phash in images:
+                self.assertEqual(pool.phash(file_bytes, timeout=60), (phash, 60 * 80))
+            # скачивание идет внутри слота: пока слот занят, download не вызывается
+            download = mock.Mock(return_value=images[0][0])
+            with pool.slots:
+                thread = Thread(target=pool.download_phash, args=(download, 60))
+                thread.start()
+                thread.join(0.2)
+                download.assert_not_called()
+            thread.join()
+            download.assert_called_once()
+        finally:
+            pool.shutdown()
+
+    def test_upload_queue(self):
+        for message_id in range(3):
+            UploadTask.enqueue(0, 100, message_id, f"file-{message_id}", f"unique-{message_id}")
+        first = UploadTask.claim()
+        self.assertEqual([(task.message_id, task.attempts) for task in first], [(0, 1)])
+        self.assertEqual([task.message_id for task in UploadTask.claim()], [1])
+        self.assertEqual([task.message_id for task in UploadTask.claim()], [2])
+        self.assertEqual(UploadTask.claim(), [])
+
+        # задача упавшего воркера возвращается в очередь, когда кончается аренда
+        first[0].delete()
+        UploadTask.objects.filter(message_id=1).update(locked_until=datetime_now() - datetime.timedelta(seconds=1))
+        self.assertEqual([(task.message_id, task.attempts) for task in UploadTask.claim()], [(1, 2)])
+        UploadTask.release([UploadTask.objects.get(message_id=2).id])
+        self.assertEqual([task.message_id for task in UploadTask.claim()], [2])
+        self.assertEqual(UploadTask.claim(), [])
+
+    def test_album_queue(self):
+        for message_id in range(3):
+            UploadTask.enqueue(1, 100, message_id, f"file-{message_id}", f"unique-{message_id}", media_group_id="album")
+        UploadTask.enqueue(1, 100, 3, "file-3", "unique-3")
+        # альбом ждет остальные картинки, одиночная не ждет
+        self.assertEqual([task.message_id for task in UploadTask.claim()], [3])
+        self.assertEqual(UploadTask.claim(), [])
+        self.assertEqual(
+            [task.message_id for task in UploadTask.claim(group_window=datetime.timedelta(0))], [0, 1, 2]
+        )
+
+        images = Image.new_images(1, [("file-a", "unique-a", "8000000000000001"), ("file-b", "unique-b", "1f")])
+        self.assertEqual([image.phash_int for image in images], [-2 ** 63 + 1, 31])
+        self.assertEqual(
+            set(ImageScore.objects.filter(image__in=images).values_list("profile__tg_id", "score")), {(1, 2)}
+        )
+
+    def test_process_uploads(self):
+        hashes = {
+            "file-a": ("f0f0f0f0f0f0f0f0", 10 ** 6),
+            # почти повтор file-a внутри альбома
+            "file-b": ("f0f0f0f0f0f0f0f1", 10 ** 6),
+            # почти повтор картинки 13 из базы (phash "13")
+            "file-c": ("113", 10 ** 6),
+            "file-d": ("ffffffff00000000", 1000),
+        }
+        with self.fake_downloads(hashes) as tg_logic:
+            for message_id, file_id in enumerate(["file-a", "file-b", "file-c", "file-d", "file-5"]):
+                UploadTask.enqueue(3, 100, message_id, file_id, file_id.replace("file-", "unique-"), "album")
+            # уже сохраненный файл
+            UploadTask.objects.filter(file_id="file-5").update(file_unique_id="5")
+            tg_logic.process_uploads(UploadTask.claim(group_window=datetime.timedelta(0)))
+
+            # повторно присланный файл не скачивается
+            self.assertEqual(
+                [call.args[0] for call in tg_logic.bot.get_file.call_args_list], ["file-a", "file-b", "file-c", "file-d"]
+            )
+            self.assertEqual(list(Image.objects.filter(profile__tg_id=3, file_unique_id__startswith="unique")
+                                  .values_list("file_unique_id", flat=True)), ["unique-a"])
+            self.assertEqual(
+                set(ImageScore.objects.filter(profile__tg_id=3, score=2).values_list("image__file_unique_id", flat=True)),
+                {"9", "10", "11", "unique-a", "13", "5"},
+            )
+            self.assertFalse(UploadTask.objects.exists())
+            # один ответ на альбом, повторы считаются по задачам
+            reply = tg_logic.bot.send_message.call_args.kwargs
+            self.assertEqual(reply["text"], tg_logic.response_text(
+                'album_saved', 3, {'saved': 1, 'duplicates': 3, 'too_small': 1}
+            ))
+            self.assertEqual(reply["reply_to_message_id"], 0)
+            self.assertIsNotNone(reply["reply_markup"])
+
+            # ошибка скачивания: задача ждет следующей попытки, после последней челику уходит ошибка
+            tg_logic.bot.send_message.reset_mock()
+            UploadTask.enqueue(3, 100, 10, "file-missing", "unique-missing")
+            for attempt in range(1, tg_logic.UPLOAD_ATTEMPTS + 1):
+                tasks = UploadTask.claim()
+                self.assertEqual(tasks[0].attempts, attempt)
+                tg_logic.process_uploads(tasks)
+                UploadTask.release([task.id for task in tasks])
+            self.assertFalse(UploadTask.objects.exists())
+            self.assertEqual(
+                tg_logic.bot.send_message.call_args.kwargs["text"], tg_logic.response_text('default_error', 3)
+            )
+
+            # вставку опередил другой процесс: задача сразу возвращается в очередь, попытки тоже кончаются
+            tg_logic.bot.send_message.reset_mock()
+            hashes["file-e"] = ("0f0f0f0f0f0f0f0f", 10 ** 6)
+            UploadTask.enqueue(3, 100, 11, "file-e", "unique-e")
+            with mock.patch.object(Image, "new_images", side_effect=IntegrityError):
+                for attempt in range(1, tg_logic.UPLOAD_ATTEMPTS):
+                    tg_logic.process_uploads(UploadTask.claim())
+                    self.assertIsNone(UploadTask.objects.get(message_id=11).locked_until)
+                    self.assertTrue(tg_logic.UPLOAD_WAKEUP.is_set())
+                    tg_logic.bot.send_message.assert_not_called()
+                tg_logic.process_uploads(UploadTask.claim())
+            self.assertFalse(UploadTask.objects.exists())
+            self.assertEqual(
+                tg_logic.bot.send_message.call_args.kwargs["text"], tg_logic.response_text('default_error', 3)
+            )
+            self.assertFalse(Image.objects.filter(file_unique_id="unique-e").exists())
+
+    def test_resent_photo(self):
+        def message(message_id, file_unique_id, size=1000):
+            return SimpleNamespace(
+                from_user=SimpleNamespace(id=3, full_name="3", language_code="ru"),
+                chat=SimpleNamespace(id=100),
+                message_id=message_id,
+                media_group_id=None,
+                photo=[SimpleNamespace(width=size, height=size, file_id=f"file-{message_id}", file_unique_id=file_unique_id)],
+            )
+
+        hashes = {
+            "file-1": ("f0f0f0f0f0f0f0f0", 10 ** 6),
+            "file-2": ("f0f0f0f0f0f0f0f1", 10 ** 6),
+            "file-3": ("0f0f0f0f0f0f0f0f", 1000),
+        }
+        with self.fake_downloads(hashes) as tg_logic:
+            # импорт views (его делает и проверка urls при старте тестов) воркеры загрузок не запускает
+            from tgbot import views  # noqa: F401
+            self.assertEqual(tg_logic.UPLOAD_THREADS, [])
+
+            # картинка из базы: ответ сразу, без очереди и скачивания
+            tg_logic.save_photo(message(0, "13"))
+            self.assertEqual(tg_logic.bot.reply_to.call_args.kwargs["text"], tg_logic.response_text('already_in_db', 3))
+            self.assertEqual(ImageScore.objects.get(profile__tg_id=3, image__file_unique_id="13").score, 2)
+            self.assertFalse(UploadTask.objects.exists())
+
+            # новые картинки идут в очередь, ответы по одной
+            replies = []
+            for message_id in (1, 2, 3):
+                tg_logic.save_photo(message(message_id, f"unique-{message_id}"))
+                self.assertEqual(tg_logic.bot.reply_to.call_args.kwargs["text"], tg_logic.response_text('img_in_queue', 3))
+                tg_logic.process_uploads(UploadTask.claim())
+                replies.append(tg_logic.bot.send_message.call_args.kwargs["text"])
+            self.assertEqual(replies, [
+                tg_logic.response_text(template, 3) for template in ('img_saved', 'already_in_db', 'img_too_small')
+            ])
+            self.assertFalse(UploadTask.objects.exists())
+
+            # только что сохраненная картинка уже в фильтре известных файлов
+            self.assertIn("unique-1", tg_logic.known_files())
+            tg_logic.save_photo(message(4, "unique-1"))
+            self.assertEqual(tg_logic.bot.reply_to.call_args.kwargs["text"], tg_logic.response_text('already_in_db', 3))
+            self.assertFalse(UploadTask.objects.exists())
+            self.assertEqual([call.args[0] for call in tg_logic.bot.get_file.call_args_list], ["file-1", "file-2", "file-3"])
+
+    def test_bloom_filter(self):
+        known = BloomFilter(1000, keys=Image.objects.values_list("file_unique_id", flat=True))
+        self.assertTrue(all(file_unique_id in known for file_unique_id in map(str, range(15))))
+        known.add("AgADnew")
+        self.assertIn("AgADnew", known)
+        # ложные "да" - около заданной доли
+        false_positives = sum(f"AgADmissing{i}" in known for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            call_command("benchmark", users=[30], predict_samples=5, output=f"{tmp_dir}/benchmark.json", stdout=io.StringIO())
+            with open(f"{tmp_dir}/benchmark.json") as file:
+                result = json.load(file)["results"][0]
+        self.assertEqual(result["users"], 30)
+        for stage in ["update_data_from_db", "fit", "lsh", "predict_many", "check_updates"]:
+            self.assertGreater(result[stage]["seconds"], 0)
+            self.assertGreater(result[stage]["peak_memory"], 0)
+        self.assertTrue(result["check_updates"]["rebuilt"])
+        self.assertGreaterEqual(result["lsh"]["recall"], 0)
+        self.assertLessEqual(result["lsh"]["recall"], 1)
+        self.assertIn("p95", result["predict"])
+        # синтетика откатывается
+        self.assertEqual(Profile.objects.count(), 5)
+
+    def test_evaluate(self):
+        self.create_scores()
+        # последние оценки - лайки, которые модель должна угадать
+        ImageScore.objects.update(datetime=datetime_now() - datetime.timedelta(days=1))
+        for i in (0, 1):
+            ImageScore.objects.filter(profile__tg_id=3, image__file_unique_id=i).delete()
+            ImageScore.set_score(3, i, 1)
+        output = io.StringIO()
+        call_command("evaluate", test_fraction=0.05, k=[2, 5], stdout=output)
+        result = json.loads(output.getvalue())
+        self.assertEqual(result["test_users"], 1)
+        self.assertEqual(result["test_scores"], 2)
+        for metric in ["precision@2", "recall@5", "coverage@5"]:
+            self.assertGreaterEqual(result[metric], 0)
+            self.assertLessEqual(result[metric], 1)
+        self.assertIn("p95", result["predict_latency"])
@@ -1,27 +1,48 @@
 import django
-import io
 import logging
 import time
 import traceback
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread, Timer
 from contextlib import suppress
 
-import imagehash
-from PIL import Image as PILImage
 from telebot.types import Message, CallbackQuery
 from telebot.util import quick_markup
 from telebot.apihelper import ApiTelegramException
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
 from project.settings import bot
 
-from tgbot.models import Image, ImageScore, Profile, Report, ImageBlock
+from tgbot.models import Image, ImageScore, Profile, Report, ImageBlock, UploadTask, MEDIA_GROUP_WINDOW
 from tgbot.recommendations import ColabFilter
+from tgbot.duplicates import BloomFilter, HashPool, PhashIndex, phash_to_int
 from tgbot.helpers import timeit
 
 
 IMAGES_CACHE = {}
 DB_LOCK = Lock()
 COLAB_FILTER = ColabFilter()
+# хэши всех картинок в памяти; загрузки других процессов сюда не попадают, точные повторы ловит unique в базе.
+# строится при первой загрузке: процессам без воркеров загрузок он не нужен
+PHASH_INDEX = None
+PHASH_INDEX_LOCK = Lock()
+HASH_POOL = HashPool(settings.PHASH_WORKERS, settings.PHASH_QUEUE)
+# file_unique_id всех картинок; с запасом на новые загрузки, при переполнении растет только доля ложных "да".
+# строится при первой присланной картинке, как и PHASH_INDEX
+KNOWN_FILES = None
+KNOWN_FILES_LOCK = Lock()
+# меньше стольких пикселей картинка не сохраняется
+MIN_RESOLUTION = 350_000
+# очередь загрузок: после стольких неудачных попыток челику уходит ошибка,
+# свободный воркер заглядывает в базу не реже чем раз в UPLOAD_POLL_INTERVAL секунд
+UPLOAD_ATTEMPTS = 3
+UPLOAD_POLL_INTERVAL = 30
+UPLOAD_WAKEUP = Event()
+UPLOAD_THREADS = []
+UPLOAD_THREADS_LOCK = Lock()
 
 
 def update_user(func):
@@ -106,6 +127,16 @@ response_templates_dict = {
         'ru': 'Изображение добавлено в очередь загрузки.',
         'default': "The image has been added to the download queue.",
     },
+    'album_saved': {
+        'ru': 'Альбом обработан!\n'
+              'Сохранено изображений: {saved}\n'
+              'Уже были в базе: {duplicates}\n'
+              'Слишком низкого качества: {too_small}',
+        'default': "Album processed!\n"
+                   "Images saved: {saved}\n"
+                   "Already in database: {duplicates}\n"
+                   "Resolution too low: {too_small}",
+    },
     'img_too_small': {
         'ru': 'Изображение слишком низкого качества!',
         'default': "The image resolution is too low!",
@@ -161,7 +192,7 @@ def save_photo(message: Message):
 
     photo = message.photo[-1]
 
-    if photo.height * photo.width < 350_000:
+    if photo.height * photo.width < MIN_RESOLUTION:
         bot.reply_to(
             message=message,
             text=response_text(
@@ -171,60 +202,234 @@ def save_photo(message: Message):
         )
         return
 
-
-    try:
-        file_info = bot.get_file(photo.file_id)
-        file_bytes = bot.download_file(file_info.file_path)
-        pil_image = PILImage.open(io.BytesIO(file_bytes))
-        phash = imagehash.phash(pil_image)
-        try:
-            with DB_LOCK:
-                Image.new_image(
-                    tg_id=tg_id,
-                    file_id=photo.file_id,
-                    file_unique_id=file_info.file_unique_id,
-                    phash=phash,
-                )
-        except django.db.utils.IntegrityError:
-            bot.reply_to(
-                message=message,
-                text=response_text(
-                    template='already_in_db',
-                    tg_id=tg_id
-                ),
+    # тот же файл повторно: ответ сразу, без очереди и скачивания; в альбоме такие отсеет process_uploads
+    if message.media_group_id is None and known_images([photo.file_unique_id]):
+        with DB_LOCK:
+            img_score = ImageScore.set_score(
+                tg_id=tg_id,
+                file_unique_id=photo.file_unique_id,
+                score=2,
             )
-            with DB_LOCK:
-                img_score = ImageScore.set_score(
-                    tg_id=tg_id,
-                    file_unique_id=Image.objects.get(phash=phash).file_unique_id,
-                    score=2,
-                )
-                COLAB_FILTER.update_score(img_score)
-            return
-
-        markup = quick_markup({
-            'Delete': {'callback_data': 'delete|' + file_info.file_unique_id},
-        })
-
+            COLAB_FILTER.update_score(img_score)
         bot.reply_to(
             message=message,
             text=response_text(
-                template='img_saved',
+                template='already_in_db',
                 tg_id=tg_id
             ),
-            reply_markup=markup,
         )
-    except Exception as e:
-        logging.error(traceback.format_exc())
+        return
+
+    # скачивание и проверка на повтор - в воркерах загрузок, вебхук отвечает сразу
+    with DB_LOCK:
+        # на альбом - один ответ, по первой картинке
+        album_queued = message.media_group_id is not None \
+            and UploadTask.objects.filter(media_group_id=message.media_group_id).exists()
+        UploadTask.enqueue(
+            tg_id=tg_id,
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            file_id=photo.file_id,
+            file_unique_id=photo.file_unique_id,
+            media_group_id=message.media_group_id,
+        )
+    if message.media_group_id is None:
+        UPLOAD_WAKEUP.set()
+    else:
+        # альбом станет доступен воркерам, когда соберутся остальные картинки
+        Timer(MEDIA_GROUP_WINDOW.total_seconds(), UPLOAD_WAKEUP.set).start()
+    if not album_queued:
         bot.reply_to(
             message=message,
             text=response_text(
-                template='default_error',
+                template='img_in_queue',
                 tg_id=tg_id
             ),
         )
 
 
+def reply_upload(task, template, str_args=None, reply_markup=None):
+    # ответ на сообщение с картинкой, даже если челик его уже удалил
+    with suppress(ApiTelegramException):
+        bot.send_message(
+            chat_id=task.chat_id,
+            text=response_text(
+                template=template,
+                tg_id=task.profile.tg_id,
+                str_args=str_args,
+            ),
+            reply_to_message_id=task.message_id,
+            allow_sending_without_reply=True,
+            reply_markup=reply_markup,
+        )
+
+
+def phash_index():
+    global PHASH_INDEX
+    with PHASH_INDEX_LOCK:
+        if PHASH_INDEX is None:
+            PHASH_INDEX = PhashIndex(Image.objects.exclude(phash_int=None).values_list("id", "phash_int").iterator())
+        return PHASH_INDEX
+
+
+def known_files():
+    global KNOWN_FILES
+    with KNOWN_FILES_LOCK:
+        if KNOWN_FILES is None:
+            KNOWN_FILES = BloomFilter(
+                Image.objects.count() * 2 + 100_000,
+                keys=Image.objects.values_list("file_unique_id", flat=True).iterator(),
+            )
+        return KNOWN_FILES
+
+
+def known_images(file_unique_ids):
+    # {file_unique_id: Image} для уже сохраненных файлов; в базу идут только те, что прошли фильтр
+    known = known_files()
+    maybe_known = [file_unique_id for file_unique_id in file_unique_ids if file_unique_id in known]
+    if not maybe_known:
+        return {}
+    with DB_LOCK:
+        return {image.file_unique_id: image for image in Image.objects.filter(file_unique_id__in=maybe_known)}
+
+
+def give_up_uploads(tasks):
+    # после UPLOAD_ATTEMPTS неудачных попыток задачи удаляются из очереди, челику уходит ошибка
+    if max(task.attempts for task in tasks) < UPLOAD_ATTEMPTS:
+        return False
+    with DB_LOCK:
+        UploadTask.objects.filter(id__in=[task.id for task in tasks]).delete()
+    reply_upload(tasks[0], 'default_error')
+    return True
+
+
+def download_phash(task):
+    file_info = bot.get_file(task.file_id)
+    # по таймауту задача ведет себя как при любой другой ошибке: ждет следующей попытки
+    phash, resolution = HASH_POOL.download_phash(
+        lambda: bot.download_file(file_info.file_path), settings.PHASH_TIMEOUT
+    )
+    return file_info.file_unique_id, phash, resolution
+
+
+@timeit
+def process_uploads(tasks):
+    # одна картинка или альбом: скачивание параллельно, поиск повторов одним запросом, вставка одной транзакцией
+    tg_id = tasks[0].profile.tg_id
+    try:
+        # уже сохраненные файлы не скачиваются
+        resent = known_images([task.file_unique_id for task in tasks])
+        downloads = [task for task in tasks if task.file_unique_id not in resent]
+        files = []
+        if downloads:
+            with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+                files = list(executor.map(download_phash, downloads))
+        index = phash_index()
+        near_ids = {
+            task.id: index.nearest(phash_to_int(phash), settings.PHASH_DISTANCE)
+            for task, (_, phash, _) in zip(downloads, files)
+        }
+        with DB_LOCK:
+            # точные повторы ищутся и в базе: картинки из других процессов в PHASH_INDEX не попадают
+            known = list(Image.objects.filter(
+                Q(id__in=[image_id for image_id in near_ids.values() if image_id is not None])
+                | Q(phash__in=[phash for _, phash, _ in files])
+                | Q(file_unique_id__in=[file_unique_id for file_unique_id, _, _ in files])
+            ))
+        by_id = {image.id: image for image in known}
+        by_key = {key: image for image in known for key in (image.phash, image.file_unique_id)}
+
+        # повторы считаются по задачам: две картинки альбома могут повторять одну и ту же из базы
+        too_small, new = [], []
+        duplicates = [task for task in tasks if task.file_unique_id in resent]
+        duplicate_images = {image.id: image for image in resent.values()}
+        # почти одинаковые картинки внутри самого альбома
+        album_index = PhashIndex()
+        numbers = {task.id: number for number, task in enumerate(tasks, 1)}
+        for task, (file_unique_id, phash, resolution) in zip(downloads, files):
+            number = numbers[task.id]
+            # размеры из сообщения проверены до постановки в очередь, здесь - у реально декодированной картинки
+            if resolution < MIN_RESOLUTION:
+                too_small.append(task)
+            elif duplicate := by_key.get(phash) or by_key.get(file_unique_id) or by_id.get(near_ids[task.id]):
+                duplicates.append(task)
+                duplicate_images[duplicate.id] = duplicate
+            elif album_index.nearest(phash_to_int(phash), settings.PHASH_DISTANCE) is not None:
+                duplicates.append(task)
+            else:
+                album_index.add(phash_to_int(phash), number)
+                new.append((number, (task.file_id, file_unique_id, phash)))
+
+        with DB_LOCK, transaction.atomic():
+            images = Image.new_images(tg_id, [file for _, file in new])
+            img_scores = [
+                ImageScore.set_score(tg_id=tg_id, file_unique_id=image.file_unique_id, score=2)
+                for image in duplicate_images.values()
+            ]
+            UploadTask.objects.filter(id__in=[task.id for task in tasks]).delete()
+        for image in images:
+            index.add(image.phash_int, image.id)
+            known_files().add(image.file_unique_id)
+        for img_score in img_scores:
+            COLAB_FILTER.update_score(img_score)
+    except django.db.utils.IntegrityError:
+        # ту же картинку успел вставить другой процесс: повтор найдется при следующей попытке
+        logging.warning(traceback.format_exc())
+        if not give_up_uploads(tasks):
+            with DB_LOCK:
+                UploadTask.release([task.id for task in tasks])
+            UPLOAD_WAKEUP.set()
+        return
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        # задачи остаются в очереди и вернутся к воркерам, когда кончится аренда
+        give_up_uploads(tasks)
+        return
+
+    delete_markup = quick_markup({
+        f'Delete {number}' if len(tasks) > 1 else 'Delete': {'callback_data': 'delete|' + image.file_unique_id}
+        for (number, _), image in zip(new, images)
+    }, row_width=5) if images else None
+    if len(tasks) > 1:
+        reply_upload(tasks[0], 'album_saved', str_args={
+            'saved': len(images),
+            'duplicates': len(duplicates),
+            'too_small': len(too_small),
+        }, reply_markup=delete_markup)
+    elif too_small:
+        reply_upload(tasks[0], 'img_too_small')
+    elif duplicates:
+        reply_upload(tasks[0], 'already_in_db')
+    else:
+        reply_upload(tasks[0], 'img_saved', reply_markup=delete_markup)
+
+
+def upload_worker():
+    while True:
+        # сброс до проверки очереди: set() из save_photo между claim и wait не теряется, wait сразу вернется
+        UPLOAD_WAKEUP.clear()
+        try:
+            with DB_LOCK:
+                tasks = UploadTask.claim()
+        except Exception:
+            logging.exception("upload queue claim failed")
+            tasks = []
+        if not tasks:
+            # новые задачи будят воркер сразу, просроченные аренды подбираются по таймауту
+            UPLOAD_WAKEUP.wait(UPLOAD_POLL_INTERVAL)
+            continue
+        process_uploads(tasks)
+
+
+def start_upload_workers():
+    # задачи живут в базе, так что оставшиеся от прошлого запуска подхватываются здесь же
+    with UPLOAD_THREADS_LOCK:
+        while len(UPLOAD_THREADS) < settings.UPLOAD_WORKERS:
+            thread = Thread(target=upload_worker, daemon=True)
+            thread.start()
+            UPLOAD_THREADS.append(thread)
+
+
 def send_photo_with_default_markup(chat_id, photo):
     image = Image.objects.get(pk=photo["image_id"])
     markup = quick_markup({
@@ -272,7 +477,12 @@ def send_photo(message):
 @timeit
 def delete_photo(callback: CallbackQuery):
     _, file_unique_id = callback.data.split('|')
-    Image.delete_image(callback.from_user.id, file_unique_id)
+    image_id = Image.delete_image(callback.from_user.id, file_unique_id)
+    COLAB_FILTER.exclude_images([image_id])
+    # еще не построенный индекс прочитает базу уже без удаленной картинки
+    with PHASH_INDEX_LOCK:
+        if PHASH_INDEX is not None:
+            PHASH_INDEX.remove(image_id)
     with suppress(ApiTelegramException):
         bot.answer_callback_query(
             callback_query_id=callback.id,
@@ -288,7 +498,7 @@ def delete_photo(callback: CallbackQuery):
 @timeit
 def block_photo(callback: CallbackQuery):
     _, file_unique_id = callback.data.split('|')
-    ImageBlock.block_image(callback.from_user.id, file_unique_id)
+    COLAB_FILTER.exclude_images([ImageBlock.block_image(callback.from_user.id, file_unique_id).image_id])
     with suppress(ApiTelegramException):
         bot.answer_callback_query(
             callback_query_id=callback.id,
@@ -394,10 +604,11 @@ def confirm_report(callback: CallbackQuery):
     COLAB_FILTER.update_score(img_score)
 
     with suppress(django.db.utils.IntegrityError):
-        Report.new_report(
+        report = Report.new_report(
             tg_id=callback.from_user.id,
             file_unique_id=unique_id,
         )
+        COLAB_FILTER.report_images([report.image_id])
 
     bot.delete_message(callback.message.chat.id, callback.message.id)
     bot.send_message(
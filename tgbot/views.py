@@ -7,7 +7,7 @@ import traceback
 import telebot
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from tgbot.tg_logic import bot
+from tgbot.tg_logic import bot, COLAB_FILTER
 from tgbot.helpers import timers_view, timeit
 
 
@@ -60,4 +60,4 @@ def telegram_handle(request):
         UPDATE_IDS = [update.update_id] + UPDATE_IDS[:1000]
         return JsonResponse({"ok": "POST processed"})
     else:
-        return JsonResponse({"ok": "GET processed", "TIMERS": timers_view()})
+        return JsonResponse({"ok": "GET processed", "TIMERS": timers_view(), "COLAB_FILTER": COLAB_FILTER.stat()})